@@ -1,15 +1,23 @@
-import os
 import re
 from pathlib import Path
 
 import pandas as pd
+import polars as pl
+
+from asc import scan_asc
+from config import SESSION_REGEX
+from metrics import MetricsStore
+
+METRICS_DIR = Path('reading_times/metrics')
 
 
 def analyse_asc(asc_file: str,
                 num: int,
                 initial_ts: int,
                 lab: str,
-                stimuli_trial_mapping: dict):
+                stimuli_trial_mapping: dict,
+                messages: pl.DataFrame | None = None,
+                session: str | None = None):
     start_ts = []
     stop_ts = []
     start_msg = []
@@ -21,30 +29,29 @@ def analyse_asc(asc_file: str,
     status = []
     stimulus_name = []
 
-    parent_folder = Path(__file__).parent.parent
-    asc_file = parent_folder / asc_file
-
-    with open(asc_file, 'r', encoding='utf8') as f:
+    if messages is None:
+        parent_folder = Path(__file__).parent.parent
+        messages = scan_asc(parent_folder / asc_file).messages
 
-        start_regex = re.compile(
-            r'MSG\s+(?P<timestamp>\d+)\s+(?P<type>start_recording)_(?P<trial>(PRACTICE_)?trial_\d\d?)_(?P<page>.*)')
-        stop_regex = re.compile(
-            r'MSG\s+(?P<timestamp>\d+)\s+(?P<type>stop_recording)_(?P<trial>(PRACTICE_)?trial_\d\d?)_(?P<page>.*)')
+    start_regex = re.compile(
+        r'(?P<type>start_recording)_(?P<trial>(PRACTICE_)?trial_\d\d?)_(?P<page>.*)')
+    stop_regex = re.compile(
+        r'(?P<type>stop_recording)_(?P<trial>(PRACTICE_)?trial_\d\d?)_(?P<page>.*)')
 
-        for l in f.readlines():
-            if match := start_regex.match(l):
-                start_ts.append(match.groupdict()['timestamp'])
-                start_msg.append(match.groupdict()['type'])
-                trials.append(match.groupdict()['trial'])
+    for timestamp, message in messages.select('timestamp', 'message').iter_rows():
+        if match := start_regex.match(message):
+            start_ts.append(timestamp)
+            start_msg.append(match.groupdict()['type'])
+            trials.append(match.groupdict()['trial'])
 
-                if match.groupdict()['trial'] in stimuli_trial_mapping:
-                    stimulus_name.append(stimuli_trial_mapping[match.groupdict()['trial']])
+            if match.groupdict()['trial'] in stimuli_trial_mapping:
+                stimulus_name.append(stimuli_trial_mapping[match.groupdict()['trial']])
 
-                pages.append(match.groupdict()['page'])
-                status.append('reading time')
-            elif match := stop_regex.match(l):
-                stop_ts.append(match.groupdict()['timestamp'])
-                stop_msg.append(match.groupdict()['type'])
+            pages.append(match.groupdict()['page'])
+            status.append('reading time')
+        elif match := stop_regex.match(message):
+            stop_ts.append(timestamp)
+            stop_msg.append(match.groupdict()['type'])
 
     total_reading_duration_ms = 0
     for start, stop in zip(start_ts, stop_ts):
@@ -105,28 +112,52 @@ def analyse_asc(asc_file: str,
     print('Total exp time: ', convert_to_time_str(total_reading_duration_ms + total_set_up_time_ms))
     print('\n')
 
-    # write total times to csv
-    total_times = pd.DataFrame({
-        'pilot': num,
-        'lab': lab,
-        'language': 'en',
+    # Every pilot writes its own partition of the metrics store, see `total_times` for
+    # the totals of all pilots
+    total_times = pl.DataFrame({
         'total_trials': [len(sum_df) / 2],
         'total_pages': [len(df) / 2],
         'total_reading_time': [convert_to_time_str(total_reading_duration_ms)],
         'total_non-reading_time': [convert_to_time_str(total_set_up_time_ms)],
         'total_exp_time': [convert_to_time_str(total_reading_duration_ms + total_set_up_time_ms)]
     })
-    if os.path.exists('reading_times/total_times.tsv'):
-        temp_total_times = pd.read_csv('reading_times/total_times.tsv', sep='\t')
-        total_times = pd.concat([temp_total_times, total_times], ignore_index=True)
-
-    total_times.to_csv('reading_times/total_times.tsv', sep='\t', index=False)
+    MetricsStore(METRICS_DIR).write(
+        f'pilot_{num}',
+        session_partition(asc_file, session),
+        {
+            'session': total_times.with_columns(pl.lit(num).alias('pilot'), pl.lit(lab).alias('lab')),
+            # Without pl.from_pandas, which needs pyarrow
+            'trial': pl.DataFrame(sum_df.to_dict('list')),
+            'screen': pl.DataFrame(df.to_dict('list')),
+        },
+    )
 
-    total_times.to_excel('reading_times/total_times.xlsx', index=False)
     sum_df.to_excel(f'reading_times/times_per_trial_pilot_{num}.xlsx', index=False)
     df.to_excel(f'reading_times/times_per_page_pilot_{num}.xlsx', index=False)
 
 
+def session_partition(asc_file: str, session: str | None = None) -> dict[str, str | int]:
+    """Partition keys of the metrics store, the same as in `batch.run_session`
+
+    They are parsed from the session name, by default the name of the first folder of
+    the ASC file that looks like a session folder, e.g. `001_EN_GB_1_ET1`.
+    """
+    names = [session] if session is not None else reversed(Path(asc_file).parent.parts)
+    for name in names:
+        if match := SESSION_REGEX.fullmatch(name):
+            return {
+                'lang': match['lang'].lower(),
+                'country': match['country'].lower(),
+                'labnum': int(match['labnum']),
+            }
+    raise ValueError(f'No session name like 001_EN_GB_1_ET1 in {session or asc_file}')
+
+
+def total_times(metrics_dir: Path = METRICS_DIR) -> pl.DataFrame:
+    """Totals of all pilots in the metrics store, with their lab and language"""
+    return MetricsStore(metrics_dir).scan('session').sort('pilot').collect()
+
+
 def convert_to_time_str(duration_ms: float) -> str:
     seconds = int(duration_ms / 1000) % 60
     minutes = int(duration_ms / (1000 * 60)) % 60
@@ -234,6 +265,7 @@ if __name__ == '__main__':
         num=5,
         lab='zh',
         initial_ts=14556585,
+        session='004_EN_GB_1_ET1',
         stimuli_trial_mapping={
             'PRACTICE_trial_1': 'Enc_WikiMoon',
             'PRACTICE_trial_2': 'Lit_NorthWind',
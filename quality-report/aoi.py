@@ -0,0 +1,276 @@
+from dataclasses import dataclass
+
+import numpy as np
+import polars as pl
+import pymovements as pm
+
+from compact import components
+from stimulus import Stimulus
+
+# Columns of the AOI files with the character and token ids. Without a character id
+# column, the row number in the AOI file is used.
+CHAR_AOI_COLUMN = "char_idx"
+TOKEN_AOI_COLUMN = "word_idx"
+
+
+@dataclass
+class PageAois:
+    """AOI boxes of one page, grouped into lines for vectorized lookups
+
+    Boxes that overlap vertically form a line band. The boxes are sorted by band and
+    left edge, so that a point is found with one binary search over `band * stride + x`.
+    """
+
+    keys: np.ndarray
+    band: np.ndarray
+    right: np.ndarray
+    top: np.ndarray
+    bottom: np.ndarray
+    band_top: np.ndarray
+    band_bottom: np.ndarray
+    band_left: np.ndarray
+    band_right: np.ndarray
+    stride: float
+    char_ids: np.ndarray
+    token_ids: np.ndarray
+
+    @classmethod
+    def build(
+        cls,
+        left: np.ndarray,
+        top: np.ndarray,
+        right: np.ndarray,
+        bottom: np.ndarray,
+        char_ids: np.ndarray,
+        token_ids: np.ndarray,
+    ) -> "PageAois":
+        # Merge the vertical extents of the boxes into non-overlapping bands
+        order = np.argsort(top, kind="stable")
+        running_bottom = np.maximum.accumulate(bottom[order])
+        new_band = np.r_[True, top[order][1:] >= running_bottom[:-1]]
+        band = np.empty(len(top), dtype=np.int64)
+        band[order] = np.cumsum(new_band) - 1
+        band_starts = np.flatnonzero(new_band)
+        band_top = top[order][band_starts]
+        band_bottom = np.maximum.reduceat(bottom[order], band_starts)
+        band_left = np.full(len(band_starts), np.inf)
+        np.minimum.at(band_left, band, left)
+        band_right = np.full(len(band_starts), -np.inf)
+        np.maximum.at(band_right, band, right)
+
+        stride = float(max(right.max(), 0)) + 1
+        keys = band * stride + left
+        order = np.argsort(keys, kind="stable")
+        return cls(
+            keys=keys[order],
+            band=band[order],
+            right=right[order],
+            top=top[order],
+            bottom=bottom[order],
+            band_top=band_top,
+            band_bottom=band_bottom,
+            band_left=band_left,
+            band_right=band_right,
+            stride=stride,
+            char_ids=char_ids[order],
+            token_ids=token_ids[order],
+        )
+
+    def lookup(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Index of the box containing each point, -1 if there is none"""
+        band = np.searchsorted(self.band_top, y, side="right") - 1
+        in_band = (band >= 0) & (y < self.band_bottom[np.maximum(band, 0)])
+        candidate = np.searchsorted(self.keys, band * self.stride + x, side="right") - 1
+        box = np.maximum(candidate, 0)
+        # NaN positions fail all comparisons
+        hit = (
+            in_band
+            & (candidate >= 0)
+            & (self.band[box] == band)
+            & (x < self.right[box])
+            & (y >= self.top[box])
+            & (y < self.bottom[box])
+        )
+        return np.where(hit, candidate, -1)
+
+
+@dataclass
+class AoiMapper:
+    """Maps gaze positions to the character and token AOIs of the stimulus pages"""
+
+    pages: dict[tuple[str, str], PageAois]
+
+    @classmethod
+    def from_stimuli(cls, stimuli: list[Stimulus]) -> "AoiMapper":
+        pages = {}
+        for stimulus in stimuli:
+            text_stimulus = stimulus.text_stimulus
+            aois = text_stimulus.aois.with_row_index("row")
+            char_column = CHAR_AOI_COLUMN if CHAR_AOI_COLUMN in aois.columns else "row"
+            token_column = TOKEN_AOI_COLUMN if TOKEN_AOI_COLUMN in aois.columns else None
+            left = pl.col(text_stimulus.start_x_column).cast(pl.Float64)
+            top = pl.col(text_stimulus.start_y_column).cast(pl.Float64)
+            if text_stimulus.width_column is not None:
+                right = left + pl.col(text_stimulus.width_column)
+                bottom = top + pl.col(text_stimulus.height_column)
+            else:
+                right = pl.col(text_stimulus.end_x_column).cast(pl.Float64)
+                bottom = pl.col(text_stimulus.end_y_column).cast(pl.Float64)
+            boxes = aois.select(
+                pl.col(text_stimulus.page_column).alias("page"),
+                left.alias("left"),
+                top.alias("top"),
+                right.alias("right"),
+                bottom.alias("bottom"),
+                pl.col(char_column).cast(pl.Int64).alias("char_id"),
+                (
+                    pl.col(token_column).cast(pl.Int64)
+                    if token_column is not None
+                    else pl.lit(-1, dtype=pl.Int64)
+                ).alias("token_id"),
+            )
+            for (page,), page_boxes in boxes.partition_by("page", as_dict=True).items():
+                # Screen names are page_1, page_2, ...
+                screen = page if str(page).startswith("page_") else f"page_{page}"
+                pages[(f"{stimulus.name}_{stimulus.id}", screen)] = PageAois.build(
+                    *(
+                        page_boxes.get_column(column).to_numpy()
+                        for column in ["left", "top", "right", "bottom"]
+                    ),
+                    char_ids=page_boxes.get_column("char_id").fill_null(-1).to_numpy(),
+                    token_ids=page_boxes.get_column("token_id").fill_null(-1).to_numpy(),
+                )
+        return cls(pages=pages)
+
+    def line_bands(self) -> pl.DataFrame:
+        """Extent of every line of text, one row per line of every page"""
+        return pl.DataFrame(
+            [
+                {
+                    "stimulus": stimulus,
+                    "screen": screen,
+                    "band_top": page.band_top.tolist(),
+                    "band_bottom": page.band_bottom.tolist(),
+                    "band_left": page.band_left.tolist(),
+                    "band_right": page.band_right.tolist(),
+                }
+                for (stimulus, screen), page in self.pages.items()
+            ],
+            schema={
+                "stimulus": pl.Utf8,
+                "screen": pl.Utf8,
+                **{column: pl.List(pl.Float64) for column in ["band_top", "band_bottom", "band_left", "band_right"]},
+            },
+        ).explode("band_top", "band_bottom", "band_left", "band_right")
+
+    def tokens(self) -> pl.DataFrame:
+        """Token AOI ids of every page, one row per token"""
+        return pl.DataFrame(
+            [
+                {
+                    "stimulus": stimulus,
+                    "screen": screen,
+                    "token_aoi_id": np.unique(page.token_ids[page.token_ids >= 0]).tolist(),
+                }
+                for (stimulus, screen), page in self.pages.items()
+            ],
+            schema={"stimulus": pl.Utf8, "screen": pl.Utf8, "token_aoi_id": pl.List(pl.Int64)},
+        ).explode("token_aoi_id").drop_nulls()
+
+    def map(self, frame: pl.DataFrame, position_column: str) -> pl.DataFrame:
+        """Add `char_aoi_id` and `token_aoi_id` for the positions in `position_column`"""
+        char_ids = np.full(frame.height, -1, dtype=np.int64)
+        token_ids = np.full(frame.height, -1, dtype=np.int64)
+        x, y = components(frame, position_column)
+        positions = frame.select(
+            pl.int_range(pl.len()).alias("row"),
+            "stimulus",
+            "screen",
+            x.cast(pl.Float64).alias("x"),
+            y.cast(pl.Float64).alias("y"),
+        )
+        for key, screen_positions in positions.partition_by(
+            ["stimulus", "screen"], as_dict=True
+        ).items():
+            page = self.pages.get(key)
+            if page is None:
+                continue  # Not a page with text, e.g. a question
+            box = page.lookup(
+                screen_positions.get_column("x").to_numpy(),
+                screen_positions.get_column("y").to_numpy(),
+            )
+            rows = screen_positions.get_column("row").to_numpy()[box >= 0]
+            char_ids[rows] = page.char_ids[box[box >= 0]]
+            token_ids[rows] = page.token_ids[box[box >= 0]]
+        return frame.with_columns(
+            pl.Series("char_aoi_id", char_ids),
+            pl.Series("token_aoi_id", token_ids),
+        ).with_columns(
+            pl.when(pl.col(column) >= 0).then(pl.col(column)).alias(column)
+            for column in ["char_aoi_id", "token_aoi_id"]
+        )
+
+
+def map_event_aois(events: pm.EventDataFrame, stimuli: list[Stimulus]) -> None:
+    """Map fixations by their location and saccades by their start position"""
+    frame = events.frame.with_columns(
+        pl.when(pl.col("name") == "fixation")
+        .then(pl.col("location"))
+        .otherwise(pl.col("start_position"))
+        .alias("aoi_position")
+    )
+    events.frame = AoiMapper.from_stimuli(stimuli).map(frame, "aoi_position").drop("aoi_position")
+
+
+def map_sample_aois(gaze: pm.GazeDataFrame, stimuli: list[Stimulus]) -> None:
+    gaze.frame = AoiMapper.from_stimuli(stimuli).map(gaze.frame, "pixel")
+
+
+def fixation_locations(gaze: pm.GazeDataFrame, stimuli: list[Stimulus]) -> pl.DataFrame:
+    """Share of the fixations of every screen on the text, next to it and off the screen
+
+    All fixations of the session are compared with the line bands of their page at once,
+    with an as-of join on the vertical position. Screens without text AOIs, e.g. the
+    questions and ratings, only have an off-screen ratio.
+    """
+    screen = gaze.experiment.screen
+    trial_columns = gaze.trial_columns
+    bands = AoiMapper.from_stimuli(stimuli).line_bands().sort("band_top")
+    x, y = pl.col("x"), pl.col("y")
+    fixations = (
+        gaze.events.frame.filter(pl.col("name") == "fixation")
+        .select(
+            *trial_columns,
+            pl.col("location").list.get(0).cast(pl.Float64).alias("x"),
+            pl.col("location").list.get(1).cast(pl.Float64).alias("y"),
+        )
+        .sort("y")
+        .join_asof(bands, left_on="y", right_on="band_top", by=["stimulus", "screen"])
+        .join(
+            bands.select("stimulus", "screen", pl.lit(True).alias("has_text")).unique(),
+            on=["stimulus", "screen"],
+            how="left",
+        )
+        .with_columns(
+            (~x.is_between(0, screen.width_px) | ~y.is_between(0, screen.height_px)).alias("off_screen"),
+            ((y < pl.col("band_bottom")) & x.is_between(pl.col("band_left"), pl.col("band_right")))
+            .fill_null(False)
+            .alias("on_text"),
+        )
+    )
+    return (
+        fixations.group_by(trial_columns)
+        .agg(
+            pl.len().alias("num_fixations"),
+            pl.col("on_text").mean().alias("on_text_ratio"),
+            (~pl.col("on_text") & ~pl.col("off_screen")).mean().alias("off_text_ratio"),
+            pl.col("off_screen").mean().alias("off_screen_ratio"),
+            pl.col("has_text").first().fill_null(False),
+        )
+        .with_columns(
+            pl.when(pl.col("has_text")).then(pl.col(column)).alias(column)
+            for column in ["on_text_ratio", "off_text_ratio"]
+        )
+        .drop("has_text")
+        .sort(trial_columns)
+    )
@@ -0,0 +1,52 @@
+import polars as pl
+import pymovements as pm
+
+import config
+
+
+def detect_artifacts(
+    gaze: pm.GazeDataFrame,
+    max_velocity: float = config.ARTIFACT_MAX_VELOCITY,
+    screen_margin_px: float = config.ARTIFACT_SCREEN_MARGIN_PX,
+) -> None:
+    """Add `artifact` events for the runs of samples with an implausible velocity or position
+
+    Uses the velocities of `pos2vel`, and finds the runs with a single run-length encoding
+    of the samples. Positions further than `screen_margin_px` outside of the screen are
+    implausible. Samples without a gaze position are data loss, not artifacts.
+    """
+    screen = gaze.experiment.screen
+    x, y = pl.col("pixel").list.get(0), pl.col("pixel").list.get(1)
+    vx, vy = pl.col("velocity").list.get(0), pl.col("velocity").list.get(1)
+    speed = (vx.pow(2) + vy.pow(2)).sqrt()
+    trial_columns = gaze.trial_columns
+    samples = gaze.frame.select(
+        *trial_columns,
+        "time",
+        # NaN is larger than every number in polars, so it has to be excluded explicitly
+        ((speed > max_velocity) & speed.is_not_nan()).fill_null(False).alias("implausible_velocity"),
+        (
+            ~x.is_between(-screen_margin_px, screen.width_px + screen_margin_px)
+            | ~y.is_between(-screen_margin_px, screen.height_px + screen_margin_px)
+        )
+        .and_(x.is_not_nan() & y.is_not_nan())
+        .fill_null(False)
+        .alias("implausible_position"),
+    ).with_columns((pl.col("implausible_velocity") | pl.col("implausible_position")).alias("artifact"))
+    artifacts = (
+        samples.group_by(pl.struct(*trial_columns, "artifact").rle_id().alias("run"), maintain_order=True)
+        .agg(
+            *(pl.col(column).first() for column in [*trial_columns, "artifact"]),
+            pl.col("time").first().alias("onset"),
+            pl.col("time").last().alias("offset"),
+        )
+        .filter(pl.col("artifact"))
+        .select(
+            *trial_columns,
+            pl.lit("artifact").alias("name"),
+            "onset",
+            "offset",
+            (pl.col("offset") - pl.col("onset")).alias("duration"),
+        )
+    )
+    gaze.events.frame = pl.concat([gaze.events.frame, artifacts], how="diagonal_relaxed")
@@ -0,0 +1,414 @@
+import math
+import re
+from array import array
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Collection, Iterable
+
+import polars as pl
+import pymovements as pm
+
+# Reuse the pymovements regexes and metadata post-processing so that the metadata
+# is identical to the one produced by `pm.gaze.from_asc`
+from pymovements.utils.parsing import (
+    BLINK_START_REGEX,
+    BLINK_STOP_REGEX,
+    CALIBRATION_REGEX,
+    CALIBRATION_TIMESTAMP_REGEX,
+    EYELINK_META_REGEXES,
+    INVALID_SAMPLE_REGEX,
+    START_RECORDING_REGEX,
+    STOP_RECORDING_REGEX,
+    VALIDATION_REGEX,
+    _pre_process_metadata,
+    compile_patterns,
+    get_pattern_keys,
+)
+
+PATTERNS = [
+    r"start_recording_(?P<trial>(?:PRACTICE_)?trial_\d+)_stimulus_(?P<stimulus>[^_]+_[^_]+_\d+)_(?P<screen>.+)",
+    r"start_recording_(?P<trial>(?:PRACTICE_)?trial_\d+)_(?P<screen>familiarity_rating_screen_\d+|subject_difficulty_screen)",
+    {"pattern": r"stop_recording_", "column": "trial", "value": None},
+    {"pattern": r"stop_recording_", "column": "screen", "value": None},
+    {
+        "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_stimulus_[^_]+_[^_]+_\d+_page_\d+",
+        "column": "activity",
+        "value": "reading",
+    },
+    {
+        "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_stimulus_[^_]+_[^_]+_\d+_question_\d+",
+        "column": "activity",
+        "value": "question",
+    },
+    {
+        "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_(familiarity_rating_screen_\d+|subject_difficulty_screen)",
+        "column": "activity",
+        "value": "rating",
+    },
+    {"pattern": r"stop_recording_", "column": "activity", "value": None},
+    {
+        "pattern": r"start_recording_PRACTICE_trial_",
+        "column": "practice",
+        "value": True,
+    },
+    {
+        "pattern": r"start_recording_trial_",
+        "column": "practice",
+        "value": False,
+    },
+    {"pattern": r"stop_recording_", "column": "practice", "value": None},
+]
+TRIAL_COLUMNS = ["trial", "stimulus", "screen"]
+
+MESSAGE_REGEX = re.compile(r"MSG\s+(?P<timestamp>\d+[.]?\d*)\s+(?P<message>.*)")
+# Lines that are not samples, and samples without a gaze position (for the data loss).
+# Matching from the newline before each line is much faster than a multiline `^`.
+METADATA_LINE_REGEX = re.compile(rb"\n(?:(?![0-9])[^\n]*|[0-9]\S*[ \t]+\.[ \t][^\n]*)")
+# Bytes read at once by `scan_asc_metadata`
+READ_BYTES = 64 * 1024 * 1024
+RECORDING_MESSAGE_REGEX = (
+    r"^(?P<event>start_recording|stop_recording)_(?P<trial>(?:PRACTICE_)?trial_\d+)"
+    r"(?:_stimulus_(?P<stimulus>[^_]+_[^_]+_\d+))?_(?P<screen>.+)$"
+)
+
+
+@dataclass
+class AscSession:
+    """Samples, messages and metadata of one ASC file, read in a single pass"""
+
+    samples: pl.DataFrame
+    messages: pl.DataFrame
+    metadata: dict[str, Any]
+
+    def to_gaze(self, trial_columns: list[str] = TRIAL_COLUMNS) -> pm.GazeDataFrame:
+        """Gaze frame of the samples, with the pixel and trial columns that were scanned"""
+        # Samples scanned with a selection of `columns` can lack some of them
+        trial_columns = [column for column in trial_columns if column in self.samples.columns]
+        pixel_columns = ["x_pix", "y_pix"]
+        has_pixels = set(pixel_columns) <= set(self.samples.columns)
+        experiment = pm.Experiment(
+            screen_width_px=self.metadata["resolution"][0],
+            screen_height_px=self.metadata["resolution"][1],
+            sampling_rate=self.metadata["sampling_rate"],
+        )
+        gaze = pm.GazeDataFrame(
+            self.samples,
+            experiment=experiment,
+            trial_columns=trial_columns or None,
+            time_column="time",
+            time_unit="ms",
+            pixel_columns=pixel_columns if has_pixels else None,
+        )
+        gaze._metadata = self.metadata
+        gaze._messages = self.messages
+        return gaze
+
+
+class AscScanner:
+    """Incremental ASC parser, the state is kept between calls to `feed`
+
+    Lines can be fed as they are written, e.g. while following a growing ASC file, and
+    `session` returns what has been scanned so far at any time.
+
+    With `trials_only`, samples outside of the trial screens (calibrations, breaks,
+    instructions) are only counted and never stored, and `stimuli` further restricts the
+    stored samples to these stimuli. The metadata, e.g. the data loss, still covers all
+    samples.
+    """
+
+    def __init__(
+        self,
+        patterns: list[dict[str, Any] | str] = PATTERNS,
+        metadata_patterns: list[dict[str, Any] | str] | None = None,
+        trials_only: bool = False,
+        stimuli: Collection[str] | None = None,
+    ) -> None:
+        self.compiled_patterns = compile_patterns(patterns)
+        self.additional_columns = sorted(get_pattern_keys(self.compiled_patterns, "column"))
+        self.current_additional = {column: None for column in self.additional_columns}
+        assert not (trials_only or stimuli is not None) or set(TRIAL_COLUMNS) <= set(
+            self.additional_columns
+        ), f"Selecting trial samples needs patterns for {TRIAL_COLUMNS}"
+        self.trials_only = trials_only or stimuli is not None
+        self.stimuli = set(stimuli) if stimuli is not None else None
+        self.keep_samples = not self.trials_only
+
+        # The pattern columns only change on messages, so we only store the sample index
+        # at which they change and expand them to all samples in `session`
+        self.states: dict[str, list[Any]] = {
+            "index": [0],
+            **{column: [None] for column in self.additional_columns},
+        }
+        self.time, self.x_pix, self.y_pix, self.pupil = array("d"), array("d"), array("d"), array("d")
+        self.message_timestamps: list[float] = []
+        self.message_texts: list[str] = []
+
+        self.metadata: defaultdict = defaultdict(str)
+        self.compiled_metadata_patterns = compile_patterns(metadata_patterns or [])
+        for key in get_pattern_keys(self.compiled_metadata_patterns, "key"):
+            self.metadata[key] = None
+        self.compiled_metadata_patterns.extend(EYELINK_META_REGEXES)
+
+        self.calibrations: list[dict[str, Any]] = []
+        self.validations: list[dict[str, Any]] = []
+        self.blinks: list[dict[str, Any]] = []
+        self.cal_timestamp = ""
+        self.blink = False
+        self.num_blink_samples = 0
+        self.num_invalid_samples = 0
+        self.start_recording_timestamp = ""
+        self.total_recording_duration = 0.0
+        # Valid samples that were counted but not parsed, see `scan_asc_metadata`
+        self.num_skipped_samples = 0
+
+    def feed(self, lines: Iterable[str]) -> None:
+        # The sample branch runs for almost every line, so it only uses local names
+        time, x_pix, y_pix, pupil = self.time, self.x_pix, self.y_pix, self.pupil
+        compiled_patterns = self.compiled_patterns
+        compiled_metadata_patterns = self.compiled_metadata_patterns
+        keep_samples = self.keep_samples
+        num_skipped_samples = self.num_skipped_samples
+        for line in lines:
+            if line.startswith("MSG") and (match := MESSAGE_REGEX.match(line)):
+                self.message_timestamps.append(float(match.group("timestamp")))
+                self.message_texts.append(match.group("message").rstrip())
+                changed = False
+                for pattern_dict in compiled_patterns:
+                    if pattern_match := pattern_dict["pattern"].match(line):
+                        if "value" in pattern_dict:
+                            self.current_additional[pattern_dict["column"]] = pattern_dict["value"]
+                        else:
+                            self.current_additional.update(pattern_match.groupdict())
+                        changed = True
+                if changed:
+                    self.states["index"].append(len(time))
+                    for column in self.additional_columns:
+                        self.states[column].append(self.current_additional[column])
+                    if self.trials_only:
+                        keep_samples = self.keep_samples = self._in_selected_trial()
+
+            if self.cal_timestamp:
+                # The line after a calibration timestamp describes the calibration
+                calibration = CALIBRATION_REGEX.match(line)
+                self.calibrations.append(
+                    {"timestamp": self.cal_timestamp, **calibration.groupdict()}
+                    if calibration
+                    else {"timestamp": self.cal_timestamp}
+                )
+                self.cal_timestamp = ""
+
+            elif line[:1].isdigit():  # Sample lines are the only lines starting with a digit
+                fields = line.split()
+                if keep_samples:
+                    time.append(float(fields[0]))
+                    x_pix.append(_to_float(fields[1]))
+                    y_pix.append(_to_float(fields[2]))
+                    pupil.append(_to_float(fields[3]))
+                else:
+                    num_skipped_samples += 1
+                if fields[1] == "." and INVALID_SAMPLE_REGEX.match(line):
+                    if self.blink:
+                        self.num_blink_samples += 1
+                    else:
+                        self.num_invalid_samples += 1
+
+            elif BLINK_START_REGEX.match(line):
+                self.blink = True
+
+            elif match := BLINK_STOP_REGEX.match(line):
+                self.blink = False
+                self.blinks.append(
+                    {
+                        "start_timestamp": float(match.group("timestamp_start")),
+                        "stop_timestamp": float(match.group("timestamp_end")),
+                        "duration_ms": float(match.group("duration_ms")),
+                        "num_samples": self.num_blink_samples,
+                    }
+                )
+                self.num_blink_samples = 0
+
+            elif match := START_RECORDING_REGEX.match(line):
+                self.start_recording_timestamp = match.group("timestamp")
+
+            elif match := STOP_RECORDING_REGEX.match(line):
+                self.total_recording_duration += float(match.group("timestamp")) - float(
+                    self.start_recording_timestamp
+                )
+
+            elif match := CALIBRATION_TIMESTAMP_REGEX.match(line):
+                self.cal_timestamp = match.group("timestamp")
+
+            elif match := VALIDATION_REGEX.match(line):
+                self.validations.append(match.groupdict())
+
+            elif compiled_metadata_patterns:
+                for pattern_dict in compiled_metadata_patterns.copy():
+                    if match := pattern_dict["pattern"].match(line):
+                        if "value" in pattern_dict:
+                            self.metadata[pattern_dict["key"]] = pattern_dict["value"]
+                        else:
+                            self.metadata.update(match.groupdict())
+                        # Each metadata pattern should only match once
+                        compiled_metadata_patterns.remove(pattern_dict)
+        self.num_skipped_samples = num_skipped_samples
+
+    def _in_selected_trial(self) -> bool:
+        current = self.current_additional
+        if current["trial"] is None or current["screen"] is None:
+            return False
+        # Rating screens keep the stimulus of the pages before them
+        return self.stimuli is None or current["stimulus"] in self.stimuli
+
+    def get_metadata(self) -> dict[str, Any]:
+        """Metadata of the lines scanned so far, without building the sample frame"""
+        data_loss_ratio, data_loss_ratio_blinks = _data_loss_ratios(
+            self.blinks,
+            self.num_invalid_samples,
+            len(self.time) + self.num_skipped_samples,
+            self.total_recording_duration,
+            self.metadata["sampling_rate"],
+        )
+        # Pre-processing changes the metadata in place, later lines may still update it
+        metadata = _pre_process_metadata(defaultdict(str, self.metadata))
+        metadata["calibrations"] = list(self.calibrations)
+        metadata["validations"] = list(self.validations)
+        metadata["blinks"] = list(self.blinks)
+        metadata["data_loss_ratio"] = data_loss_ratio
+        metadata["data_loss_ratio_blinks"] = data_loss_ratio_blinks
+        metadata["total_recording_duration_ms"] = self.total_recording_duration
+        return metadata
+
+    def get_messages(self) -> pl.DataFrame:
+        return pl.DataFrame(
+            {
+                "timestamp": pl.Series(self.message_timestamps, dtype=pl.Float64),
+                "message": pl.Series(self.message_texts, dtype=pl.Utf8),
+            }
+        ).with_columns(
+            pl.col("message").str.extract_groups(RECORDING_MESSAGE_REGEX).struct.unnest()
+        )
+
+    def lazy_samples(self, columns: list[str] | None = None) -> pl.LazyFrame:
+        """Samples scanned so far, only `columns` (and always `time`) are built"""
+        arrays = {"time": self.time, "x_pix": self.x_pix, "y_pix": self.y_pix, "pupil": self.pupil}
+        if columns is None:
+            columns = [*arrays, *self.additional_columns]
+        columns = ["time", *(column for column in columns if column != "time")]
+        for column in columns:
+            assert column in arrays or column in self.additional_columns, f"Unknown sample column {column}"
+        samples = pl.LazyFrame(
+            {column: pl.Series(arrays[column], dtype=pl.Float64) for column in columns if column in arrays}
+        )
+        additional = [column for column in columns if column in self.additional_columns]
+        if additional:
+            state_frame = (
+                pl.LazyFrame({column: self.states[column] for column in ["index", *additional]}, strict=False)
+                .with_columns(pl.col("index").cast(pl.Int64))
+                .unique("index", keep="last", maintain_order=True)
+            )
+            samples = (
+                samples.with_row_index("index")
+                .with_columns(pl.col("index").cast(pl.Int64))
+                .join_asof(state_frame, on="index", strategy="backward")
+                .drop("index")
+            )
+        return samples.select(columns)
+
+    def session(self, columns: list[str] | None = None) -> AscSession:
+        return AscSession(
+            samples=self.lazy_samples(columns).collect(),
+            messages=self.get_messages(),
+            metadata=self.get_metadata(),
+        )
+
+
+def scan_asc(
+    asc_file: Path | int,
+    patterns: list[dict[str, Any] | str] = PATTERNS,
+    metadata_patterns: list[dict[str, Any] | str] | None = None,
+    trials_only: bool = False,
+    stimuli: Collection[str] | None = None,
+    columns: list[str] | None = None,
+) -> AscSession:
+    """Scan an ASC file, see `AscScanner` for `trials_only` and `stimuli`
+
+    With `columns`, only these sample columns are built, e.g. `["x_pix", "trial"]`.
+    """
+    scanner = AscScanner(patterns, metadata_patterns, trials_only=trials_only, stimuli=stimuli)
+    with open(asc_file, encoding="utf-8") as f:
+        scanner.feed(f)
+    assert scanner.metadata, f"No metadata found in {asc_file}"
+    return scanner.session(columns)
+
+
+def scan_asc_metadata(
+    asc_file: Path, metadata_patterns: list[dict[str, Any] | str] | None = None
+) -> dict[str, Any]:
+    """Same metadata as `scan_asc`, without parsing the valid samples
+
+    Sample lines are the only lines starting with a digit. They are counted on the raw
+    bytes, and only the other lines and the samples without a gaze position are decoded
+    and parsed.
+    """
+    return _scan_without_samples(asc_file, metadata_patterns).get_metadata()
+
+
+def scan_asc_messages(asc_file: Path) -> pl.DataFrame:
+    """Same messages as `scan_asc`, without parsing the valid samples"""
+    return _scan_without_samples(asc_file).get_messages()
+
+
+def _scan_without_samples(
+    asc_file: Path, metadata_patterns: list[dict[str, Any] | str] | None = None
+) -> AscScanner:
+    scanner = AscScanner(patterns=[], metadata_patterns=metadata_patterns)
+    num_skipped_samples = 0
+    rest = b""
+    with open(asc_file, "rb") as f:
+        while True:
+            data = f.read(READ_BYTES)
+            chunk = rest + data
+            # Only scan complete lines, unless the file ended
+            end = chunk.rfind(b"\n") + 1 if data else len(chunk)
+            chunk, rest = chunk[:end], chunk[end:]
+            if chunk:
+                # Every line starts after a newline, including the first one
+                block = b"\n" + chunk.removesuffix(b"\n")
+                lines = METADATA_LINE_REGEX.findall(block)
+                # All other lines are valid samples
+                num_skipped_samples += block.count(b"\n") - len(lines)
+                scanner.feed(line[1:].rstrip(b"\r").decode("utf-8") + "\n" for line in lines)
+            if not data:
+                break
+    assert scanner.metadata, f"No metadata found in {asc_file}"
+    scanner.num_skipped_samples = num_skipped_samples
+    return scanner
+
+
+def _to_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def _data_loss_ratios(
+    blinks: list[dict[str, Any]],
+    num_invalid_samples: int,
+    num_samples: int,
+    total_recording_duration: float,
+    sampling_rate: str,
+) -> tuple[float | str, float | str]:
+    # Same computation as in pymovements, but without keeping every invalid timestamp
+    if not sampling_rate or not total_recording_duration:
+        return "unknown", "unknown"
+    num_expected_samples = total_recording_duration * float(sampling_rate) / 1000
+    num_blink_samples = sum(blink["num_samples"] for blink in blinks)
+    num_lost_samples = (
+        num_expected_samples - num_samples + num_blink_samples + num_invalid_samples
+    )
+    return (
+        num_lost_samples / num_expected_samples,
+        num_blink_samples / num_expected_samples,
+    )
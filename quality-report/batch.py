@@ -0,0 +1,314 @@
+import argparse
+import dataclasses
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+
+import polars as pl
+
+import config
+from aoi import map_event_aois
+from asc import scan_asc
+from cache import CACHE_VERSION, cached_session_dir, load_preprocessed
+from compact import trial_key_dtypes
+from edf import scan_edf
+from export import EXPORT_FORMATS, export_samples
+from logfile import find_logfile, reconcile_screens, scan_logfiles
+from metrics import METRICS_VERSION, MetricsStore, session_metrics
+from plot import Screens, plot_gaze, plot_main_sequence
+from reading_measures import write_reading_measures
+from report import (
+    check_artifacts,
+    check_data_loss,
+    check_events,
+    check_flow,
+    check_gaze,
+    check_metadata,
+    check_screens,
+    check_validations,
+    report_to_file,
+)
+from stimulus import LabConfig, catalog_fingerprint, load_stimuli, screen_manifest
+from timeline import Timeline
+
+@dataclass
+class Session:
+    name: str
+    participant_id: str
+    session_dir: Path
+    recording_file: Path  # ASC file, or EDF file if it was not converted yet
+    lang: str
+    country: str
+    labnum: int
+
+
+def find_sessions(sessions_dir: Path) -> list[Session]:
+    sessions = []
+    for session_dir in sorted(sessions_dir.rglob("*_ET1")):
+        match = config.SESSION_REGEX.fullmatch(session_dir.name)
+        if not session_dir.is_dir() or match is None:
+            continue
+        if "quality_reports" in session_dir.relative_to(sessions_dir).parts:
+            continue  # Our own output folders have the same names
+        recording_files = list(session_dir.glob("*.asc")) or list(session_dir.glob("*.edf"))
+        if len(recording_files) != 1:
+            logging.warning(f"Skipping {session_dir}: found {len(recording_files)} ASC/EDF files")
+            continue
+        sessions.append(
+            Session(
+                name=session_dir.name,
+                participant_id=match["participant_id"],
+                session_dir=session_dir,
+                recording_file=recording_files[0],
+                lang=match["lang"].lower(),
+                country=match["country"].lower(),
+                labnum=int(match["labnum"]),
+            )
+        )
+    return sessions
+
+
+def run_session(
+    session: Session,
+    stimulus_dir: Path,
+    output_dir: Path,
+    force: bool = False,
+    export_format: str | None = None,
+    compact: bool = False,
+) -> bool:
+    """Run the whole quality report for one session, returns False if it was up to date"""
+    session_output_dir = output_dir / session.name
+    session_output_dir.mkdir(parents=True, exist_ok=True)
+    plots_dir = session_output_dir / f"{session.name}_plots"
+    plots_dir.mkdir(exist_ok=True)
+    done_file = session_output_dir / f"{session.name}_done.json"
+
+    lab_config = LabConfig.load(stimulus_dir, session.lang, session.country, session.labnum)
+    preprocess_kwargs = {
+        "sg_window_length": config.SG_WINDOW_LENGTH,
+        "sg_degree": config.SG_DEGREE,
+        "partition_by": config.PREPROCESS_PARTITION_BY,
+    }
+    # Cheap up-to-date check on the file stats, without opening the cache
+    recording_stat = session.recording_file.stat()
+    stamp = {
+        "cache_version": CACHE_VERSION,
+        "metrics_version": METRICS_VERSION,
+        "recording_file": str(session.recording_file),
+        "recording_size": recording_stat.st_size,
+        "recording_mtime_ns": recording_stat.st_mtime_ns,
+        "lab_config": dataclasses.asdict(lab_config),
+        # AOI files and images, fixing them changes the AOI mapping and the plots
+        "stimuli": hashlib.sha256(
+            json.dumps(catalog_fingerprint(stimulus_dir, session.lang, session.country, session.labnum)).encode()
+        ).hexdigest(),
+        "preprocess": preprocess_kwargs,
+        "export_format": export_format,
+        "compact": compact,
+    }
+    stamp = json.loads(json.dumps(stamp))  # Tuples become lists, as when reading it back
+    if not force and done_file.exists():
+        with open(done_file, encoding="utf-8") as f:
+            if json.load(f).get("stamp") == stamp:
+                return False
+    done_file.unlink(missing_ok=True)
+
+    stimuli, _ = load_stimuli(
+        stimulus_dir, session.lang, session.country, session.labnum, output_dir / "stimulus_catalog"
+    )
+    # EDF files are converted and scanned at the same time, without writing an ASC file
+    key_dtypes = trial_key_dtypes(stimuli) if compact else None
+    gaze = load_preprocessed(
+        session.recording_file,
+        lab_config,
+        session_output_dir / "cache",
+        scan=partial(scan_edf if session.recording_file.suffix == ".edf" else scan_asc, trials_only=True),
+        key_dtypes=key_dtypes,
+        **preprocess_kwargs,
+    )
+    cache_dir = cached_session_dir(
+        session.recording_file, lab_config, session_output_dir / "cache", key_dtypes, **preprocess_kwargs
+    )
+    map_event_aois(gaze.events, stimuli)
+    write_reading_measures(gaze.events, stimuli, session_output_dir, session.participant_id)
+
+    with open(session_output_dir / f"{session.name}_report.txt", "w", encoding="utf-8") as report_file:
+        report = partial(report_to_file, report_file=report_file)
+        check_metadata(gaze._metadata, report)
+        check_validations(Timeline.build(gaze._messages, gaze._metadata), report)
+        logfile = find_logfile(session.session_dir)
+        check_screens(
+            gaze._messages,
+            screen_manifest(stimuli),
+            report,
+            logfile=scan_logfiles({session.name: logfile}).collect() if logfile is not None else None,
+        )
+        check_flow(gaze._messages, report)
+        check_gaze(gaze, report)
+        check_data_loss(gaze, report)
+        check_artifacts(gaze, report)
+        check_events(gaze, report, stimuli)
+
+    screens = Screens.split(gaze)
+    for stimulus in stimuli:
+        plot_gaze(gaze, stimulus, plots_dir, screens)
+    plot_main_sequence(gaze.events, plots_dir)
+
+    MetricsStore(output_dir / "metrics").write(
+        session.name,
+        {"lang": session.lang, "country": session.country, "labnum": session.labnum},
+        session_metrics(gaze),
+    )
+
+    if export_format is not None:
+        export_samples(gaze.frame, session_output_dir / "samples", session.participant_id, export_format)
+
+    with open(done_file, "w", encoding="utf-8") as f:
+        # The messages are kept for `reconcile_logfiles`, which runs after all sessions
+        json.dump({"stamp": stamp, "messages_file": str(cache_dir / "messages.arrow")}, f, indent=2)
+    return True
+
+
+def reconcile_logfiles(sessions: list[Session], stimulus_dir: Path, output_dir: Path) -> list[str]:
+    """Write the screens of the logfiles and the ASC files side by side, one file per lab
+
+    The messages are read from the session caches of `run_session`, sessions without a
+    finished run are left out. Returns the labs whose reconciliation failed.
+    """
+    labs: dict[tuple[str, str, int], list[Session]] = {}
+    for session in sessions:
+        done_file = output_dir / session.name / f"{session.name}_done.json"
+        if done_file.exists() and find_logfile(session.session_dir) is not None:
+            labs.setdefault((session.lang, session.country, session.labnum), []).append(session)
+    reconciliation_dir = output_dir / "logfile_reconciliation"
+    reconciliation_dir.mkdir(parents=True, exist_ok=True)
+    failed = []
+    for (lang, country, labnum), lab_sessions in labs.items():
+        lab = f"{lang}_{country}_{labnum}"
+        try:
+            stimuli, _ = load_stimuli(stimulus_dir, lang, country, labnum, output_dir / "stimulus_catalog")
+            messages = []
+            for session in lab_sessions:
+                with open(output_dir / session.name / f"{session.name}_done.json", encoding="utf-8") as f:
+                    messages_file = json.load(f)["messages_file"]
+                messages.append(
+                    pl.scan_ipc(messages_file, memory_map=True).with_columns(pl.lit(session.name).alias("session"))
+                )
+            logfiles = scan_logfiles({session.name: find_logfile(session.session_dir) for session in lab_sessions})
+            reconciled = reconcile_screens(logfiles, pl.concat(messages), screen_manifest(stimuli)).collect()
+            reconciled.write_csv(reconciliation_dir / f"{lab}.tsv", separator="\t")
+        except Exception:
+            logging.exception(f"{lab}: logfile reconciliation failed")
+            failed.append(lab)
+    return failed
+
+
+def _limit_memory(memory_limit_gb: float | None) -> None:
+    if memory_limit_gb is None:
+        return
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        logging.warning("Memory limit is not supported on this platform")
+        return
+    limit = int(memory_limit_gb * 1024**3)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Generate quality reports for all sessions in an eye-tracking-sessions directory"
+    )
+    parser.add_argument("sessions_dir", type=Path, help="Path to the eye-tracking-sessions directory")
+    parser.add_argument("stimulus_dir", type=Path, help="Path to the stimulus directory")
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        help="Path to save the reports (default: SESSIONS_DIR/quality_reports)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Number of sessions processed in parallel"
+    )
+    parser.add_argument("--memory-limit-gb", type=float, help="Memory limit per worker in GB")
+    parser.add_argument("--force", action="store_true", help="Also rerun sessions that are up to date")
+    parser.add_argument(
+        "--export-samples",
+        choices=EXPORT_FORMATS,
+        help="Also write the samples of every stimulus to a file in this format",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Keep the samples with float32 coordinates and categorical trial keys, to use less memory",
+    )
+    args = parser.parse_args()
+    if args.output_dir is None:
+        args.output_dir = args.sessions_dir / "quality_reports"
+
+    logging.basicConfig(level=logging.INFO)
+
+    sessions = find_sessions(args.sessions_dir)
+    logging.info(f"Found {len(sessions)} sessions")
+
+    # Build the stimulus catalog of each lab once, instead of in every worker at the same time
+    for lang, country, labnum in sorted({(s.lang, s.country, s.labnum) for s in sessions}):
+        try:
+            load_stimuli(args.stimulus_dir, lang, country, labnum, args.output_dir / "stimulus_catalog")
+        except Exception:
+            # The sessions of this lab fail with the same error below
+            logging.exception(f"Could not load the stimuli of {lang}_{country}_{labnum}")
+
+    # Share the cores between the workers instead of letting every worker start a full
+    # polars thread pool. Workers are spawned, so they pick this up when importing polars.
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, os.cpu_count() // args.workers))
+    failed = []
+    reprocessed = []
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_limit_memory,
+        initargs=(args.memory_limit_gb,),
+        max_tasks_per_child=1,  # Give the memory of each session back to the OS
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_session,
+                session,
+                args.stimulus_dir,
+                args.output_dir,
+                args.force,
+                args.export_samples,
+                args.compact,
+            ): session
+            for session in sessions
+        }
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                if future.result():
+                    logging.info(f"{session.name}: done")
+                    reprocessed.append(session)
+                else:
+                    logging.info(f"{session.name}: up to date, skipped")
+            except Exception:
+                logging.exception(f"{session.name}: failed")
+                failed.append(session.name)
+
+    # Only the labs with new results, including their sessions that were up to date
+    labs = {(s.lang, s.country, s.labnum) for s in reprocessed}
+    lab_sessions = [s for s in sessions if (s.lang, s.country, s.labnum) in labs]
+    for lab in reconcile_logfiles(lab_sessions, args.stimulus_dir, args.output_dir):
+        failed.append(f"logfile reconciliation of {lab}")
+
+    if failed:
+        raise SystemExit(f"{len(failed)} failed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
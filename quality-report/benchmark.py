@@ -0,0 +1,163 @@
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+import polars as pl
+
+from analysis_reading_time import analyse_asc
+from asc import scan_asc_metadata
+from plot import Screens, load_data, plot_gaze, preprocess
+from report import check_gaze, check_metadata, report_to_file
+from stimulus import LabConfig
+from synth import EYES, SessionSpec, synthetic_stimuli, write_asc
+
+# Each stage is (setup, run), only `run` is timed. The setup prepares its input, e.g.
+# `preprocess` needs the loaded data.
+Stage = tuple[Callable[[Path, SessionSpec, Path], Any], Callable[[Any], None]]
+
+
+def _lab_config(spec: SessionSpec) -> LabConfig:
+    resolution = (spec.screen_width_px, spec.screen_height_px)
+    return LabConfig(resolution, (37.0, 28.0), 60.0, resolution, (37.0, 28.0))
+
+
+def _load(asc_file: Path, spec: SessionSpec, work_dir: Path) -> Any:
+    return load_data(asc_file, _lab_config(spec))
+
+
+def _preprocessed(asc_file: Path, spec: SessionSpec, work_dir: Path) -> Any:
+    gaze = _load(asc_file, spec, work_dir)
+    preprocess(gaze)
+    return gaze, synthetic_stimuli(spec, work_dir / "images"), work_dir / "plots"
+
+
+def _plot(state: Any) -> None:
+    gaze, stimuli, plots_dir = state
+    plots_dir.mkdir(exist_ok=True)
+    screens = Screens.split(gaze)
+    for stimulus in stimuli:
+        plot_gaze(gaze, stimulus, plots_dir, screens)
+
+
+def _analyse_asc(state: Any) -> None:
+    asc_file, spec, work_dir = state
+    # Writes its tables relative to the working directory
+    os.chdir(work_dir)
+    (work_dir / "reading_times").mkdir(exist_ok=True)
+    mapping = {trial: name for trial, name, _ in spec.trials()}
+    analyse_asc(str(asc_file), 0, 1_000_000, "synthetic", mapping, session="001_EN_CH_1_ET1")
+
+
+STAGES: dict[str, Stage] = {
+    "load_data": (lambda *args: args, lambda args: _load(*args)),
+    "preprocess": (_load, preprocess),
+    "plot_gaze": (_preprocessed, _plot),
+    "check_metadata": (
+        lambda asc_file, spec, work_dir: asc_file,
+        lambda asc_file: check_metadata(scan_asc_metadata(asc_file), _discard_report),
+    ),
+    "check_gaze": (_load, lambda gaze: check_gaze(gaze, _discard_report)),
+    "analyse_asc": (lambda *args: args, _analyse_asc),
+}
+
+
+def _discard_report(*args: Any, **kwargs: Any) -> None:
+    report_to_file(*args, report_file=io.StringIO(), **kwargs)
+
+
+def run_stage(stage: str, asc_file: Path, spec: SessionSpec, work_dir: Path) -> dict[str, Any]:
+    """Run one stage in this process, returns its wall time and the peak RSS of the process
+
+    The peak RSS includes the setup of the stage, e.g. the loaded data for `preprocess`.
+    """
+    setup, run = STAGES[stage]
+    state = setup(asc_file, spec, work_dir)
+    start = time.perf_counter()
+    run(state)
+    wall_time = time.perf_counter() - start
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return {"stage": stage, "wall_time_s": wall_time, "peak_rss_mb": None}
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024**2 if os.uname().sysname == "Darwin" else peak_rss / 1024
+    return {"stage": stage, "wall_time_s": wall_time, "peak_rss_mb": peak_rss_mb}
+
+
+def run_benchmark(
+    spec: SessionSpec, work_dir: Path, stages: list[str] = list(STAGES), repeat: int = 1
+) -> pl.DataFrame:
+    """Wall time and peak RSS of every stage on a synthetic session
+
+    Every run of a stage is a fresh process, so that the peak RSS of one stage does not
+    carry over into the next. The ASC file is generated once per spec and reused.
+    """
+    work_dir.mkdir(parents=True, exist_ok=True)
+    asc_file = work_dir / (
+        f"synthetic_{spec.sampling_rate}hz_{spec.duration_min:g}min_{spec.eye}"
+        f"_{spec.noise_px:g}px_{spec.seed}.asc"
+    )
+    if not asc_file.exists():
+        logging.info(f"Writing {asc_file}...")
+        write_asc(asc_file, spec)
+    results = []
+    for stage in stages:
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                try:
+                    result = executor.submit(run_stage, stage, asc_file, spec, work_dir).result()
+                except Exception as error:
+                    logging.exception(f"{stage} failed")
+                    result = {"stage": stage, "wall_time_s": None, "peak_rss_mb": None, "error": repr(error)}
+            logging.info(f"{stage}: {result['wall_time_s']} s, {result['peak_rss_mb']} MB")
+            results.append(result)
+    return pl.DataFrame(
+        results,
+        schema={"stage": pl.Utf8, "wall_time_s": pl.Float64, "peak_rss_mb": pl.Float64, "error": pl.Utf8},
+    ).with_columns(
+        pl.lit(spec.sampling_rate).alias("sampling_rate"),
+        pl.lit(spec.duration_min).alias("duration_min"),
+        pl.lit(spec.eye).alias("eye"),
+        pl.lit(asc_file.stat().st_size / 1024**2).alias("asc_size_mb"),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the wall time and peak memory of the quality report on a synthetic session"
+    )
+    parser.add_argument("work_dir", type=Path, help="Directory for the synthetic session and the outputs")
+    parser.add_argument("--sampling-rate", type=int, default=1000, help="Samples per second")
+    parser.add_argument("--duration-min", type=float, default=60.0, help="Recording time in minutes")
+    parser.add_argument("--eye", choices=list(EYES), default="L", help="Tracked eye")
+    parser.add_argument("--noise-px", type=float, default=0.5, help="Gaze noise during fixations")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the session")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every stage")
+    parser.add_argument("--output", type=Path, help="Path to save the results as TSV")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    spec = SessionSpec(
+        sampling_rate=args.sampling_rate,
+        duration_min=args.duration_min,
+        eye=args.eye,
+        noise_px=args.noise_px,
+        seed=args.seed,
+    )
+    results = run_benchmark(spec, args.work_dir.resolve(), args.stages, args.repeat)
+    if args.output is not None:
+        results.write_csv(args.output, separator="\t")
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import dataclasses
+import datetime
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import Any, Callable
+
+import polars as pl
+import pymovements as pm
+
+from asc import AscSession, scan_asc
+from compact import compact_samples
+from plot import load_data, preprocess
+from stimulus import LabConfig
+
+# Bump this whenever `load_data` or `preprocess` change their output, so that old
+# caches are not reused
+CACHE_VERSION = 6
+# Bytes at the start and at the end of the recording file that are part of the cache key
+PARTIAL_HASH_BYTES = 1 << 20
+
+
+def session_key(
+    asc_file: Path,
+    lab_config: LabConfig,
+    key_dtypes: dict[str, pl.DataType] | None = None,
+    **preprocess_kwargs: Any,
+) -> str:
+    """Hash of everything that determines the preprocessed session"""
+    key = hashlib.sha256()
+    key.update(f"version={CACHE_VERSION}\n".encode())
+    key.update(f"key_dtypes={key_dtypes!r}\n".encode())
+    # Reading the whole multi-GB recording file on every open would take longer than
+    # loading the cache, its stats and both ends identify it well enough
+    stat = asc_file.stat()
+    key.update(f"size={stat.st_size}\nmtime_ns={stat.st_mtime_ns}\n".encode())
+    with open(asc_file, "rb") as f:
+        key.update(f.read(PARTIAL_HASH_BYTES))
+        f.seek(max(stat.st_size - PARTIAL_HASH_BYTES, 0))
+        key.update(f.read(PARTIAL_HASH_BYTES))
+    key.update(json.dumps(dataclasses.asdict(lab_config), sort_keys=True).encode())
+    key.update(json.dumps(preprocess_kwargs, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def cached_session_dir(
+    asc_file: Path,
+    lab_config: LabConfig,
+    cache_dir: Path,
+    key_dtypes: dict[str, pl.DataType] | None = None,
+    **preprocess_kwargs: Any,
+) -> Path:
+    """Directory of the session in the cache, it exists once `load_preprocessed` has run"""
+    return cache_dir / session_key(asc_file, lab_config, key_dtypes, **preprocess_kwargs)
+
+
+def load_preprocessed(
+    asc_file: Path,
+    lab_config: LabConfig,
+    cache_dir: Path,
+    scan: Callable[[Path], AscSession] = scan_asc,
+    key_dtypes: dict[str, pl.DataType] | None = None,
+    **preprocess_kwargs: Any,
+) -> pm.GazeDataFrame:
+    """Load the preprocessed session from the cache, or create and cache it
+
+    The ASC file is only scanned (with `scan`) if the session is not cached yet. EDF files
+    can be used directly with `scan=edf.scan_edf`. With `key_dtypes`, the samples are kept
+    in the compact layout of `compact.compact_samples`.
+    """
+    session_dir = cached_session_dir(asc_file, lab_config, cache_dir, key_dtypes, **preprocess_kwargs)
+    if (session_dir / "session.json").exists():
+        return load_session(session_dir)
+    gaze = load_data(asc_file, lab_config, session=scan(asc_file))
+    preprocess(gaze, **preprocess_kwargs)
+    if key_dtypes is not None:
+        gaze.frame = compact_samples(gaze.frame, key_dtypes)
+    save_session(gaze, session_dir)
+    return gaze
+
+
+def save_session(gaze: pm.GazeDataFrame, session_dir: Path) -> None:
+    # Write into a temporary directory first so that a crash never leaves a half written cache
+    tmp_dir = session_dir.with_name(session_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    # Uncompressed IPC files can be memory-mapped when loading
+    gaze.frame.write_ipc(tmp_dir / "gaze.arrow", compression="uncompressed")
+    gaze.events.frame.write_ipc(tmp_dir / "events.arrow", compression="uncompressed")
+    gaze._messages.write_ipc(tmp_dir / "messages.arrow", compression="uncompressed")
+    screen = gaze.experiment.screen
+    session = {
+        "trial_columns": gaze.trial_columns,
+        "n_components": gaze.n_components,
+        "experiment": {
+            "screen_width_px": screen.width_px,
+            "screen_height_px": screen.height_px,
+            "screen_width_cm": screen.width_cm,
+            "screen_height_cm": screen.height_cm,
+            "distance_cm": screen.distance_cm,
+            "origin": screen.origin,
+            "sampling_rate": gaze.experiment.sampling_rate,
+        },
+        "metadata": gaze._metadata,
+    }
+    with open(tmp_dir / "session.json", "w", encoding="utf-8") as f:
+        json.dump(session, f, indent=2, default=_to_json)
+
+    shutil.rmtree(session_dir, ignore_errors=True)
+    tmp_dir.rename(session_dir)
+
+
+def load_session(session_dir: Path) -> pm.GazeDataFrame:
+    with open(session_dir / "session.json", encoding="utf-8") as f:
+        session = json.load(f)
+    metadata = session["metadata"]
+    if metadata.get("resolution") is not None:
+        metadata["resolution"] = tuple(metadata["resolution"])
+    if metadata.get("datetime") is not None:
+        metadata["datetime"] = datetime.datetime.fromisoformat(metadata["datetime"])
+
+    # The frames are assigned after construction so that GazeDataFrame does not copy
+    # the memory-mapped columns
+    gaze = pm.GazeDataFrame(experiment=pm.Experiment(**session["experiment"]))
+    gaze.frame = pl.read_ipc(session_dir / "gaze.arrow", memory_map=True)
+    gaze.trial_columns = session["trial_columns"]
+    gaze.n_components = session["n_components"]
+    events = pl.read_ipc(session_dir / "events.arrow", memory_map=True)
+    gaze.events = pm.EventDataFrame(
+        events.select(*session["trial_columns"], "name", "onset", "offset"),
+        trial_columns=session["trial_columns"],
+    )
+    gaze.events.frame = events  # EventDataFrame drops the event properties otherwise
+    gaze._metadata = metadata
+    gaze._messages = pl.read_ipc(session_dir / "messages.arrow", memory_map=True)
+    return gaze
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot store {type(value).__name__} in the session cache")
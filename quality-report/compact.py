@@ -0,0 +1,94 @@
+import logging
+
+import polars as pl
+
+from event_properties import COMPONENT_COLUMNS
+from stimulus import Stimulus, screen_manifest
+
+ACTIVITIES = ["reading", "question", "rating"]
+# Largest timestamp that still fits into the narrow time column
+MAX_COMPACT_TIME = 2**32 - 1
+
+
+def trial_key_dtypes(stimuli: list[Stimulus]) -> dict[str, pl.DataType]:
+    """Types of the trial key columns in the compact layout, from the stimulus catalog
+
+    Trial names are not in the catalog, so `trial` is categorical. Using the same enums
+    for every session of a lab keeps their frames compatible, e.g. for `pl.concat`.
+    """
+    manifest = screen_manifest(stimuli)
+    return {
+        "trial": pl.Categorical(),
+        "stimulus": pl.Enum([f"{stimulus.name}_{stimulus.id}" for stimulus in stimuli]),
+        "screen": pl.Enum(manifest.get_column("screen").unique(maintain_order=True).to_list()),
+        "activity": pl.Enum(ACTIVITIES),
+    }
+
+
+def compact_samples(frame: pl.DataFrame, key_dtypes: dict[str, pl.DataType]) -> pl.DataFrame:
+    """Compact layout of a gaze frame
+
+    The list columns are split into Float32 `{column}_x` and `{column}_y` columns, the trial
+    keys become categoricals and the integer `time` becomes UInt32 if it fits. A float `time`,
+    e.g. of 2000 Hz recordings, is kept as it is, Float32 cannot hold its half milliseconds.
+    This is about four times smaller than the layout of `pm.GazeDataFrame`, `expand_samples`
+    converts back.
+    """
+    key_dtypes = {column: dtype for column, dtype in key_dtypes.items() if column in frame.columns}
+    for column, dtype in key_dtypes.items():
+        if isinstance(dtype, pl.Enum):
+            # Values that are not in the catalog, e.g. from an old experiment version, are kept
+            categories = dtype.categories.to_list()
+            extra = frame.get_column(column).drop_nulls().unique(maintain_order=True)
+            extra = extra.filter(~extra.is_in(categories)).to_list()
+            if extra:
+                logging.warning(f"Values of {column} that are not in the stimulus catalog: {extra}")
+                key_dtypes[column] = pl.Enum([*categories, *extra])
+    time = frame.get_column("time")
+    narrow_time = time.dtype.is_integer() and time.min() >= 0 and time.max() <= MAX_COMPACT_TIME
+    return frame.select(
+        pl.col("time").cast(pl.UInt32) if narrow_time else pl.col("time"),
+        *(
+            pl.col(column).list.get(i).cast(pl.Float32).alias(f"{column}_{axis}")
+            for column in COMPONENT_COLUMNS
+            if column in frame.columns
+            for i, axis in enumerate("xy")
+        ),
+        *(
+            pl.col(column).cast(key_dtypes[column]) if column in key_dtypes else pl.col(column)
+            for column in frame.columns
+            if column not in ["time", *COMPONENT_COLUMNS]
+        ),
+    ).with_columns(pl.col(pl.Float64).exclude("time").cast(pl.Float32))
+
+
+def expand_samples(frame: pl.DataFrame) -> pl.DataFrame:
+    """Layout of `pm.GazeDataFrame` from the compact layout, for the pymovements transformations"""
+    if not is_compact(frame):
+        return frame
+    components = [column for column in COMPONENT_COLUMNS if f"{column}_x" in frame.columns]
+    return frame.select(
+        # Only the narrow integer time is widened, float times are kept as they are
+        pl.col("time").cast(pl.Int64) if frame.schema["time"] == pl.UInt32 else pl.col("time"),
+        *(
+            pl.concat_list(
+                pl.col(f"{column}_x").cast(pl.Float64), pl.col(f"{column}_y").cast(pl.Float64)
+            ).alias(column)
+            for column in components
+        ),
+        pl.exclude("time", *(f"{column}_{axis}" for column in components for axis in "xy")),
+    ).with_columns(
+        pl.col(pl.Categorical, pl.Enum).cast(pl.Utf8),
+        pl.col(pl.Float32).cast(pl.Float64),
+    )
+
+
+def is_compact(frame: pl.DataFrame) -> bool:
+    return "pixel_x" in frame.columns
+
+
+def components(frame: pl.DataFrame, column: str) -> tuple[pl.Expr, pl.Expr]:
+    """x and y of a list column of the gaze frame, in either layout"""
+    if f"{column}_x" in frame.columns:
+        return pl.col(f"{column}_x"), pl.col(f"{column}_y")
+    return pl.col(column).list.get(0), pl.col(column).list.get(1)
@@ -0,0 +1,55 @@
+from typing import Sequence
+
+import polars as pl
+
+from logfile import logfile_screens, normalize_logfile
+
+SCREEN_KEYS = ["stimulus", "screen"]
+
+
+def observed_screens_asc(messages: pl.DataFrame, by: Sequence[str] = ()) -> pl.DataFrame:
+    """Distinct recorded screens from the `start_recording_` messages, without any samples
+
+    The `by` columns, e.g. a session column, are kept and separate the trials.
+    """
+    return (
+        messages.filter(pl.col("event") == "start_recording")
+        .select(
+            *by,
+            "trial",
+            # Rating screens belong to the stimulus of their trial
+            pl.col("stimulus").drop_nulls().first().over(*by, "trial").alias("stimulus"),
+            "screen",
+        )
+        .unique(maintain_order=True)
+    )
+
+
+def observed_screens_logfile(
+    logfile: pl.DataFrame, manifest: pl.DataFrame, by: Sequence[str] = ()
+) -> pl.DataFrame:
+    """Distinct screens in the `EXPERIMENT_LOGFILE`, named as in the ASC file, with the `by` columns"""
+    return (
+        logfile_screens(normalize_logfile(logfile.lazy()), manifest)
+        .sort(*by, "logfile_row")
+        .select(*by, pl.col("trial_number").cast(pl.Utf8).alias("trial"), "stimulus", "screen")
+        .collect()
+    )
+
+
+def screen_completeness(
+    expected: pl.DataFrame, observed: pl.DataFrame, by: Sequence[str] = ()
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Missing and unexpected screens, from two anti-joins
+
+    `expected` is the screen manifest, `observed` comes from `observed_screens_asc` or
+    `observed_screens_logfile`. To check a whole dataset in one query, concatenate the
+    observed screens of all sessions with a session column (`by=["session"]` in
+    `observed_screens_asc`), join the manifest of each session's lab to the sessions for
+    `expected`, and pass the same `by`.
+    """
+    on = [*by, *SCREEN_KEYS]
+    expected = expected.select(on).unique()
+    missing = expected.join(observed.select(on), on=on, how="anti").sort(on)
+    unexpected = observed.join(expected, on=on, how="anti")
+    return missing, unexpected
@@ -1,10 +1,21 @@
 import math
+import re
 
 infinity = math.inf
 
+# Names of the session folders, e.g. 001_ZH_CH_1_ET1
+SESSION_REGEX = re.compile(
+    r"(?P<participant_id>\d+)_(?P<lang>[A-Za-z]{2})_(?P<country>[A-Za-z]{2})_(?P<labnum>\d+)_ET1"
+)
+
 # Fixation detection (Savitzky-Golay)
 SG_WINDOW_LENGTH = 50  # milliseconds
 SG_DEGREE = 2
+# Optical artifacts, e.g. reflections on glasses
+ARTIFACT_MAX_VELOCITY = 500  # degrees per second
+ARTIFACT_SCREEN_MARGIN_PX = 100  # gaze further outside of the screen is implausible
+# Preprocess one screen at a time to bound the memory usage, None for the whole session at once
+PREPROCESS_PARTITION_BY = ["trial", "stimulus", "screen"]
 
 # Acceptable thresholds
 ACCEPTABLE_NUM_CALIBRATIONS = [2, 5]
@@ -16,6 +27,9 @@ ACCEPTABLE_DATA_LOSS_RATIOS = (0.0, 0.10)
 ACCEPTABLE_RECORDING_DURATIONS = (600, 7200)  # seconds
 ACCEPTABLE_NUM_PRACTICE_TRIALS = 2
 ACCEPTABLE_NUM_TRIALS = 10
+ACCEPTABLE_ARTIFACT_RATIOS = (0.0, 0.01)
+ACCEPTABLE_ON_TEXT_FIXATION_RATIOS = (0.8, 1.0)
+ACCEPTABLE_OFF_SCREEN_FIXATION_RATIOS = (0.0, 0.05)
 
 EXPECTED_SAMPLING_RATE = 1000  # Hz
 
@@ -0,0 +1,87 @@
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any
+
+from asc import AscSession, scan_asc
+
+# The binary from the EyeLink Developers Kit, use the one in the repository if it is there
+EDF2ASC = Path(__file__).parent.parent / "edf2asc"
+EDF2ASC_OPTIONS = ["-input", "-ftime", "-y"]
+
+
+def scan_edf(edf_file: Path, edf2asc: Path | str | None = None, **scan_kwargs: Any) -> AscSession:
+    """Convert an EDF file with edf2asc and scan the output while it is being written
+
+    edf2asc can only write to files, so it writes into a named pipe that `scan_asc`
+    reads from. The ASC file never exists on disk and conversion and parsing overlap.
+    Where named pipes are not available (Windows), a temporary ASC file is used.
+    """
+    if edf2asc is None:
+        edf2asc = EDF2ASC if EDF2ASC.exists() else "edf2asc"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asc_file = Path(tmp_dir) / f"{Path(edf_file).stem}.asc"
+        log_file = Path(tmp_dir) / "edf2asc.log"
+        command = [str(edf2asc), *EDF2ASC_OPTIONS, str(edf_file), str(asc_file)]
+        with open(log_file, "w", encoding="utf-8") as log:
+            if not hasattr(os, "mkfifo"):
+                process = subprocess.run(
+                    command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT
+                )
+                _check_edf2asc(process.returncode, log_file, edf_file)
+                return scan_asc(asc_file, **scan_kwargs)
+
+            os.mkfifo(asc_file)
+            # Hold the read end and a writer of our own, so that neither edf2asc nor we block
+            # when opening the pipe. The file only ends when our writer is closed after
+            # edf2asc exited, even if edf2asc failed before opening the pipe.
+            reader = writer = None
+            try:
+                reader = os.open(asc_file, os.O_RDONLY | os.O_NONBLOCK)
+                os.set_blocking(reader, True)
+                writer = os.open(asc_file, os.O_WRONLY)
+                process = subprocess.Popen(
+                    command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT
+                )
+            except BaseException:
+                # E.g. edf2asc is not installed, no watcher closes the pipe then
+                for fd in [reader, writer]:
+                    if fd is not None:
+                        os.close(fd)
+                raise
+        watcher = threading.Thread(target=_close_on_exit, args=(process, writer))
+        watcher.start()
+        try:
+            # `scan_asc` closes the reader when it is done, without readers edf2asc stops
+            # if the scan failed halfway
+            session = scan_asc(reader, **scan_kwargs)
+        except Exception:
+            # Scanning the pipe fails if it got no data, e.g. if edf2asc replaced it
+            watcher.join()
+            if not asc_file.is_file():
+                raise
+        finally:
+            watcher.join()
+            _check_edf2asc(process.returncode, log_file, edf_file)
+        # Checked explicitly, the empty pipe might also scan without an error
+        if asc_file.is_file():
+            logging.info(f"edf2asc replaced the pipe with a regular file for {edf_file}")
+            return scan_asc(asc_file, **scan_kwargs)
+        if session.messages.is_empty():  # scan_asc asserts on this, but not under python -O
+            raise ValueError(f"edf2asc wrote no ASC data for {edf_file}")
+        return session
+
+
+def _close_on_exit(process: subprocess.Popen, fd: int) -> None:
+    process.wait()
+    os.close(fd)
+
+
+def _check_edf2asc(returncode: int, log_file: Path, edf_file: Path) -> None:
+    # edf2asc does not use its exit code consistently, `scan_asc` fails if there was no output
+    if returncode != 0:
+        log = log_file.read_text(encoding="utf-8", errors="replace").strip()
+        logging.warning(f"edf2asc exited with {returncode} for {edf_file}: {log}")
@@ -0,0 +1,130 @@
+from typing import Any, Callable
+
+import polars as pl
+import pymovements as pm
+
+# The list columns of the gaze frame that the properties can use, they are split into
+# their x and y components before the aggregation
+COMPONENT_COLUMNS = ["pixel", "position", "velocity"]
+
+
+def _components(column: str) -> tuple[pl.Expr, pl.Expr]:
+    return pl.col(f"{column}_x"), pl.col(f"{column}_y")
+
+
+def duration() -> pl.Expr:
+    return pl.col("offset").first() - pl.col("onset").first()
+
+
+def location(position_column: str = "position") -> pl.Expr:
+    x, y = _components(position_column)
+    return pl.concat_list(x.mean(), y.mean())
+
+
+def start_position(position_column: str = "position") -> pl.Expr:
+    x, y = _components(position_column)
+    return pl.concat_list(x.first(), y.first())
+
+
+def end_position(position_column: str = "position") -> pl.Expr:
+    x, y = _components(position_column)
+    return pl.concat_list(x.last(), y.last())
+
+
+def amplitude(position_column: str = "position") -> pl.Expr:
+    x, y = _components(position_column)
+    return ((x.max() - x.min()).pow(2) + (y.max() - y.min()).pow(2)).sqrt()
+
+
+def dispersion(position_column: str = "position") -> pl.Expr:
+    x, y = _components(position_column)
+    return x.max() - x.min() + y.max() - y.min()
+
+
+def peak_velocity(velocity_column: str = "velocity") -> pl.Expr:
+    x, y = _components(velocity_column)
+    return (x.pow(2) + y.pow(2)).sqrt().max()
+
+
+def mean_velocity(velocity_column: str = "velocity") -> pl.Expr:
+    x, y = _components(velocity_column)
+    return (x.pow(2) + y.pow(2)).sqrt().mean()
+
+
+# Same definitions as the pymovements event properties of the same name
+PROPERTIES: dict[str, Callable[..., pl.Expr]] = {
+    function.__name__: function
+    for function in [
+        duration,
+        location,
+        start_position,
+        end_position,
+        amplitude,
+        dispersion,
+        peak_velocity,
+        mean_velocity,
+    ]
+}
+
+
+def add_event_properties(
+    gaze: pm.GazeDataFrame,
+    properties: list[tuple[str, dict[str, Any], str | None]],
+) -> None:
+    """Compute event properties and add them as columns to `gaze.events`
+
+    `properties` are tuples of property name, keyword arguments and the name of the
+    events to compute it for (None for all events). Unlike `pm.EventGazeProcessor`,
+    which filters the gaze frame once per event and property, the samples are assigned
+    to their events with a single sorted join and all properties are computed in one
+    grouped aggregation.
+    """
+    for property, _, _ in properties:
+        assert property in PROPERTIES, f"Unknown event property {property}, expected one of {list(PROPERTIES)}"
+    if gaze.events.frame.is_empty():
+        return
+    identifiers = gaze.trial_columns
+    events = gaze.events.frame.drop(
+        [property for property, _, _ in properties if property in gaze.events.frame.columns]
+    ).with_row_index("event")
+
+    samples = gaze.frame.select(
+        "time",
+        *identifiers,
+        *[
+            pl.col(column).list.get(i).alias(f"{column}_{axis}")
+            for column in COMPONENT_COLUMNS
+            if column in gaze.frame.columns
+            for i, axis in enumerate("xy")
+        ],
+    ).sort("time")
+    # Events with the same name never overlap, so every sample belongs to the last event
+    # starting before it, if that event has not ended yet
+    event_samples = pl.concat(
+        [
+            samples.join_asof(
+                events.filter(pl.col("name") == name)
+                .select("event", *identifiers, "onset", "offset")
+                .sort("onset"),
+                left_on="time",
+                right_on="onset",
+                by=identifiers,
+                strategy="backward",
+            ).filter(pl.col("time") <= pl.col("offset"))
+            for name in events.get_column("name").unique(maintain_order=True)
+        ]
+    )
+    values = event_samples.group_by("event").agg(
+        PROPERTIES[property](**kwargs).alias(property) for property, kwargs, _ in properties
+    )
+
+    gaze.events.frame = (
+        events.join(values, on="event", how="left")
+        .sort("event")
+        .with_columns(
+            pl.when(pl.col("name") == event_name).then(pl.col(property)).alias(property)
+            for property, _, event_name in properties
+            if event_name is not None
+        )
+        .drop("event")
+    )
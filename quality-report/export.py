@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import polars as pl
+
+from compact import components, is_compact
+
+EXPORT_FORMATS = ["csv", "parquet"]
+# Rows written at once, bounds the memory used by each writer
+CHUNK_ROWS = 500_000
+
+
+def sample_columns(frame: pl.DataFrame) -> list[pl.Expr]:
+    """Columns of the sample-level files (README step 1)"""
+    if "pixel" in frame.columns or is_compact(frame):  # Gaze frame
+        pixel_x, pixel_y = components(frame, "pixel")
+    else:  # Samples of a scanned ASC file
+        pixel_x = pl.col("x_pix")
+        pixel_y = pl.col("y_pix")
+    return [
+        pl.col("screen"),
+        pl.col("time"),
+        pixel_x.alias("pixel_x"),
+        pixel_y.alias("pixel_y"),
+        pl.col("pupil"),
+    ]
+
+
+def export_samples(
+    frame: pl.DataFrame,
+    output_dir: Path,
+    participant_id: str,
+    format: str = "csv",
+    workers: int = 4,
+) -> list[Path]:
+    """Write the samples of every stimulus to `{participant_id}_{stimulus}-samples.{format}`
+
+    The frame is split by stimulus once, and every file is written in chunks of
+    `CHUNK_ROWS` rows, with `workers` files written at the same time.
+    """
+    assert format in EXPORT_FORMATS, f"Unknown export format {format}, expected one of {EXPORT_FORMATS}"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    columns = sample_columns(frame)
+    partitions = (
+        frame.select("stimulus")
+        .with_row_index("row")
+        .filter(pl.col("stimulus").is_not_null())
+        .group_by("stimulus", maintain_order=True)
+        .agg("row")
+    )
+    write = _write_csv if format == "csv" else _write_parquet
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                write,
+                frame,
+                rows,
+                columns,
+                output_dir / f"{participant_id}_{stimulus}-samples.{format}",
+            )
+            for stimulus, rows in zip(partitions.get_column("stimulus"), partitions.get_column("row"))
+        ]
+        return [future.result() for future in futures]
+
+
+def _is_contiguous(rows: pl.Series) -> bool:
+    # The samples of a stimulus are usually contiguous, then slicing does not copy them
+    return rows[-1] - rows[0] + 1 == len(rows)
+
+
+def _chunks(frame: pl.DataFrame, rows: pl.Series, columns: list[pl.Expr]):
+    contiguous = _is_contiguous(rows)
+    for start in range(0, len(rows), CHUNK_ROWS):
+        if contiguous:
+            chunk = frame.slice(rows[0] + start, min(CHUNK_ROWS, len(rows) - start))
+        else:
+            chunk = frame[rows[start : start + CHUNK_ROWS]]
+        yield chunk.select(columns)
+
+
+def _write_csv(frame: pl.DataFrame, rows: pl.Series, columns: list[pl.Expr], path: Path) -> Path:
+    with open(path, "wb") as f:
+        for i, chunk in enumerate(_chunks(frame, rows, columns)):
+            chunk.write_csv(f, include_header=i == 0)
+    return path
+
+
+def _write_parquet(frame: pl.DataFrame, rows: pl.Series, columns: list[pl.Expr], path: Path) -> Path:
+    # Streamed by polars itself in row groups of up to CHUNK_ROWS rows, without pyarrow
+    samples = frame.lazy().slice(rows[0], len(rows)) if _is_contiguous(rows) else frame[rows].lazy()
+    samples.select(columns).sink_parquet(path, row_group_size=CHUNK_ROWS)
+    return path
@@ -0,0 +1,310 @@
+import argparse
+import logging
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import polars as pl
+
+from asc import RECORDING_MESSAGE_REGEX, scan_asc_messages
+
+
+@dataclass(frozen=True)
+class Step:
+    """A message, or a sequence of steps, that occurs between `min` and `max` times
+
+    `max=None` allows any number of repetitions.
+    """
+
+    items: str | tuple["Step", ...]
+    min: int = 1
+    max: int | None = 1
+
+
+def seq(*items: Step | str, min: int = 1, max: int | None = 1) -> Step:
+    return Step(tuple(item if isinstance(item, Step) else Step(item) for item in items), min, max)
+
+
+def optional(*items: Step | str) -> Step:
+    return seq(*items, min=0)
+
+
+@dataclass(frozen=True)
+class FlowSpec:
+    """Expected order of the messages of a session
+
+    Recording messages are matched without their trial number and stimulus, e.g.
+    `start_recording_trial_2_stimulus_Lit_Solaris_3_page_1` is `start_recording_trial_page`.
+    Other messages are matched on their first word, so `fixation_trigger:skipped_by_experimenter`
+    is `fixation_trigger`. Messages in `anywhere` may occur at any point, and messages that
+    are not in the spec at all (e.g. the EyeLink messages) are ignored.
+    """
+
+    flow: Step
+    anywhere: frozenset[str] = frozenset()
+
+
+def _recording(screen: str, practice: bool = False) -> Step:
+    trial = "PRACTICE_trial" if practice else "trial"
+    # Only pages and questions show an image
+    images = (
+        [optional(f"{screen}_screen_image_onset"), optional(f"{screen}_screen_image_offset")]
+        if screen in ["page", "question"]
+        else []
+    )
+    return seq(f"start_recording_{trial}_{screen}", *images, f"stop_recording_{trial}_{screen}")
+
+
+def _rating(screen: str, practice: bool, min: int = 1) -> Step:
+    return seq(f"showing_{screen}", _recording(screen, practice), min=min)
+
+
+def _trial(practice: bool = False) -> Step:
+    return seq(
+        seq(_recording("page", practice), max=None),
+        seq(_recording("question", practice), min=0, max=None),
+        _rating("familiarity_rating_screen_1", practice),
+        _rating("familiarity_rating_screen_2", practice, min=0),
+        _rating("subject_difficulty_screen", practice),
+    )
+
+
+# Every trial after the first is preceded by a validation, and there is exactly one
+# obligatory break between two trials
+EXPERIMENT_FLOW = FlowSpec(
+    flow=seq(
+        "welcome_screen",
+        "informed_consent_screen",
+        "start_experiment",
+        "stimulus_order_version",
+        "showing_instruction_screen_1",
+        "showing_instruction_screen_2",
+        "showing_instruction_screen_3",
+        "camera_setup_screen",
+        "practice_text_starting_screen",
+        seq(_trial(practice=True), max=None),
+        "transition_screen",
+        optional("validation_before_stimulus"),
+        _trial(),
+        seq("validation_before_stimulus", _trial(), min=0, max=None),
+        "obligatory_break",
+        "obligatory_break_end",
+        seq("validation_before_stimulus", _trial(), max=None),
+        "final_validation",
+        "show_final_screen",
+    ),
+    anywhere=frozenset(
+        [
+            "empty_screen",
+            "fixation_trigger",
+            "optional_break_screen",
+            "optional_break",
+            "optional_break_end",
+            "optional_break_duration",
+            "obligatory_break_duration",
+        ]
+    ),
+)
+
+_RECORDING_REGEX = re.compile(RECORDING_MESSAGE_REGEX)
+_FIRST_WORD_REGEX = re.compile(r"[\s:]")
+
+
+def message_symbol(message: str) -> str:
+    """The message as it is matched against a `FlowSpec`"""
+    match = _RECORDING_REGEX.match(message)
+    if match is None:
+        return _FIRST_WORD_REGEX.split(message, maxsplit=1)[0]
+    screen = match["screen"]
+    if screen.startswith("page_"):
+        screen = "page"
+    elif screen.startswith("question_"):
+        screen = "question"
+    trial = "PRACTICE_trial" if match["trial"].startswith("PRACTICE_") else "trial"
+    return f"{match['event']}_{trial}_{screen}"
+
+
+@dataclass
+class FlowAutomaton:
+    """Deterministic finite automaton compiled from a `FlowSpec`
+
+    Checking a session is a single pass over its messages with one dictionary lookup per
+    message. On a deviation the automaton resynchronises: if the message is expected later
+    in the flow, the messages on the shortest path to it are reported as missing, otherwise
+    the message is reported as unexpected and skipped.
+    """
+
+    transitions: list[dict[str, int]]
+    accepting: list[bool]
+    symbols: frozenset[str]
+    anywhere: frozenset[str]
+    _recoveries: dict[tuple[int, str | None], tuple[tuple[str, ...], int] | None] = field(
+        default_factory=dict, repr=False
+    )
+
+    @classmethod
+    def compile(cls, spec: FlowSpec) -> "FlowAutomaton":
+        nfa = _Nfa()
+        start = nfa.add_state()
+        end = nfa.add_step(spec.flow, start)
+
+        # Subset construction, the DFA states are the epsilon closures of NFA states
+        initial = nfa.closure({start})
+        dfa_states = {initial: 0}
+        transitions: list[dict[str, int]] = [{}]
+        queue = deque([initial])
+        while queue:
+            nfa_states = queue.popleft()
+            targets: dict[str, set[int]] = {}
+            for state in nfa_states:
+                for symbol, target in nfa.transitions[state]:
+                    if symbol is not None:
+                        targets.setdefault(symbol, set()).add(target)
+            for symbol, target_states in targets.items():
+                target = nfa.closure(target_states)
+                if target not in dfa_states:
+                    dfa_states[target] = len(dfa_states)
+                    transitions.append({})
+                    queue.append(target)
+                transitions[dfa_states[nfa_states]][symbol] = dfa_states[target]
+        accepting = [False] * len(dfa_states)
+        for nfa_states, state in dfa_states.items():
+            accepting[state] = end in nfa_states
+        return cls(
+            transitions=transitions,
+            accepting=accepting,
+            symbols=frozenset(symbol for targets in transitions for symbol in targets),
+            anywhere=spec.anywhere,
+        )
+
+    def check(self, messages: pl.DataFrame) -> pl.DataFrame:
+        """Deviations from the flow, with the timestamp and message where they were found"""
+        deviations = []
+        state = 0
+        timestamp, message = None, None
+        for timestamp, message in zip(
+            messages.get_column("timestamp").to_list(), messages.get_column("message").to_list()
+        ):
+            message = message.strip()
+            symbol = message_symbol(message)
+            if symbol in self.anywhere:
+                continue
+            next_state = self.transitions[state].get(symbol)
+            if next_state is not None:
+                state = next_state
+                continue
+            if symbol not in self.symbols and not symbol.startswith(("start_recording_", "stop_recording_")):
+                continue  # Not part of the flow
+            recovery = self._recover(state, symbol)
+            if recovery is None:
+                expected = ", ".join(sorted(self.transitions[state])) or "end of session"
+                deviations.append((timestamp, message, "unexpected", f"expected {expected}"))
+            else:
+                missing, state = recovery
+                deviations.append((timestamp, message, "missing", f"before it: {', '.join(missing)}"))
+        if not self.accepting[state]:
+            missing, _ = self._recover(state, None)
+            deviations.append((timestamp, message, "missing", f"at the end: {', '.join(missing)}"))
+        return pl.DataFrame(
+            deviations,
+            schema={"timestamp": pl.Float64, "message": pl.Utf8, "deviation": pl.Utf8, "detail": pl.Utf8},
+            orient="row",
+        )
+
+    def _recover(self, state: int, symbol: str | None) -> tuple[tuple[str, ...], int] | None:
+        """Shortest sequence of missing symbols after which `symbol` (or the end) is accepted"""
+        key = (state, symbol)
+        if key not in self._recoveries:
+            self._recoveries[key] = None
+            paths: dict[int, tuple[str, ...]] = {state: ()}
+            queue = deque([state])
+            while queue:
+                current = queue.popleft()
+                if symbol is None and self.accepting[current]:
+                    self._recoveries[key] = (paths[current], current)
+                    break
+                if symbol is not None and symbol in self.transitions[current]:
+                    self._recoveries[key] = (paths[current], self.transitions[current][symbol])
+                    break
+                for next_symbol, target in self.transitions[current].items():
+                    if target not in paths:
+                        paths[target] = paths[current] + (next_symbol,)
+                        queue.append(target)
+        return self._recoveries[key]
+
+
+class _Nfa:
+    """Thompson construction of a `Step`, with `None` as the epsilon symbol"""
+
+    def __init__(self) -> None:
+        self.transitions: list[list[tuple[str | None, int]]] = []
+
+    def add_state(self) -> int:
+        self.transitions.append([])
+        return len(self.transitions) - 1
+
+    def add_step(self, step: Step, start: int) -> int:
+        """Add the states of `step` after `start`, returns its end state"""
+        end = start
+        for _ in range(step.min):
+            end = self._add_items(step.items, end)
+        if step.max is None:
+            # Loop on a fresh state, so that the loop does not reach back before `end`
+            loop = self.add_state()
+            self.transitions[end].append((None, loop))
+            self.transitions[self._add_items(step.items, loop)].append((None, loop))
+            return loop
+        optional_ends = []
+        for _ in range(step.max - step.min):
+            optional_ends.append(end)
+            end = self._add_items(step.items, end)
+        for optional_end in optional_ends:
+            self.transitions[optional_end].append((None, end))
+        return end
+
+    def _add_items(self, items: str | tuple[Step, ...], start: int) -> int:
+        if isinstance(items, str):
+            end = self.add_state()
+            self.transitions[start].append((items, end))
+            return end
+        for step in items:
+            start = self.add_step(step, start)
+        return start
+
+    def closure(self, states: set[int]) -> frozenset[int]:
+        closure = set(states)
+        stack = list(states)
+        while stack:
+            for symbol, target in self.transitions[stack.pop()]:
+                if symbol is None and target not in closure:
+                    closure.add(target)
+                    stack.append(target)
+        return frozenset(closure)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Check the order of the experiment messages in ASC files"
+    )
+    parser.add_argument("asc_files", type=Path, nargs="+", help="Paths to the ASC files")
+    parser.add_argument("--output", type=Path, help="Path to save all deviations as TSV")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    automaton = FlowAutomaton.compile(EXPERIMENT_FLOW)
+    deviations = []
+    for asc_file in args.asc_files:
+        session_deviations = automaton.check(scan_asc_messages(asc_file))
+        logging.info(f"{asc_file}: {session_deviations.height} deviations")
+        deviations.append(session_deviations.with_columns(pl.lit(str(asc_file)).alias("asc_file")))
+    deviations = pl.concat(deviations)
+    if args.output is not None:
+        deviations.write_csv(args.output, separator="\t")
+    else:
+        with pl.Config(tbl_rows=-1, fmt_str_lengths=200):
+            print(deviations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import polars as pl
+
+from asc import AscScanner
+
+# Bytes read at once, bounds the memory used when starting on a large file
+READ_BYTES = 64 * 1024 * 1024
+
+
+@dataclass
+class FileTail:
+    """Reads the complete lines appended to a growing file since the last read"""
+
+    path: Path
+    offset: int = 0
+    partial: bytes = b""
+
+    def read_lines(self) -> list[str]:
+        if not self.path.exists():
+            return []  # Not created yet
+        with open(self.path, "rb") as f:
+            f.seek(0, 2)
+            assert f.tell() >= self.offset, f"{self.path} was truncated while following it"
+            f.seek(self.offset)
+            data = f.read(READ_BYTES)
+        self.offset += len(data)
+        # Only complete lines are returned, the rest is kept until its newline is written
+        data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        # Same lines as when iterating over the file in text mode
+        text = data[:end].decode("utf-8").replace("\r\n", "\n")
+        return [line + "\n" for line in text.split("\n")[:-1]]
+
+
+@dataclass
+class LogfileTail:
+    """Rows appended to the tab-separated `EXPERIMENT_LOGFILE` of the experiment"""
+
+    tail: FileTail
+    header: list[str] | None = None
+    rows: list[list[str]] = field(default_factory=list)
+
+    def read(self) -> bool:
+        """Read the new rows, returns whether there were any"""
+        lines = self.tail.read_lines()
+        if lines and self.header is None:
+            self.header = lines.pop(0).rstrip("\n").split("\t")
+        for line in lines:
+            values = line.rstrip("\n").split("\t")
+            # Pad or cut rows that do not match the header
+            self.rows.append((values + [""] * len(self.header))[: len(self.header)])
+        return bool(lines)
+
+    def to_frame(self) -> pl.DataFrame | None:
+        if self.header is None:
+            return None
+        return pl.DataFrame(
+            self.rows,
+            schema={column: pl.Utf8 for column in self.header},
+            orient="row",
+        )
+
+
+def follow_asc(
+    asc_file: Path,
+    on_update: Callable[[AscScanner, pl.DataFrame | None], None],
+    logfile: Path | None = None,
+    poll_interval: float = 5.0,
+    idle_timeout: float = 600.0,
+) -> AscScanner:
+    """Scan a growing ASC file and call `on_update` after every `stop_recording_` message
+
+    Only the lines appended since the last poll are parsed, the scanner keeps the byte
+    offset and the message pattern state in between. `on_update` gets the scanner and the
+    rows of the `EXPERIMENT_LOGFILE` read so far. Following stops when neither file grew for
+    `idle_timeout` seconds, or on Ctrl+C. The returned scanner holds the whole session.
+    """
+    scanner = AscScanner()
+    asc_tail = FileTail(Path(asc_file))
+    logfile_tail = LogfileTail(FileTail(Path(logfile))) if logfile is not None else None
+    last_change = time.monotonic()
+    try:
+        while True:
+            num_messages = len(scanner.message_texts)
+            offset = asc_tail.offset
+            lines = asc_tail.read_lines()
+            scanner.feed(lines)
+            logfile_changed = logfile_tail is not None and logfile_tail.read()
+            if asc_tail.offset != offset or logfile_changed:
+                last_change = time.monotonic()
+            elif time.monotonic() - last_change > idle_timeout:
+                logging.info(f"No new data for {idle_timeout:g} s, stopped following {asc_file}")
+                break
+
+            if any(
+                message.startswith("stop_recording_")
+                for message in scanner.message_texts[num_messages:]
+            ):
+                on_update(scanner, logfile_tail.to_frame() if logfile_tail is not None else None)
+            if not lines:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logging.info(f"Stopped following {asc_file}")
+    return scanner
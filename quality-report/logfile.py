@@ -0,0 +1,158 @@
+import logging
+from pathlib import Path
+
+import polars as pl
+
+# The IDs that are compared with the ASC file and the stimuli, all other columns are strings
+LOGFILE_SCHEMA = {"trial_number": pl.Int64, "stimulus_number": pl.Int64, "page_number": pl.Utf8}
+COMPLETED_STIMULI_SCHEMA = {"stimulus_id": pl.Int64}
+
+
+def find_logfile(session_dir: Path) -> Path | None:
+    logfiles = sorted((session_dir / "logfiles").glob("EXPERIMENT_LOGFILE_*.txt"))
+    if len(logfiles) > 1:
+        logging.warning(f"Found {len(logfiles)} EXPERIMENT_LOGFILEs in {session_dir}, using none")
+    return logfiles[0] if len(logfiles) == 1 else None
+
+
+def scan_logfiles(logfiles: dict[str, Path]) -> pl.LazyFrame:
+    """Lazily scan the `EXPERIMENT_LOGFILE` of every session, keyed by the session name
+
+    Logfiles of different experiment versions can have different columns, missing
+    columns are null.
+    """
+    return normalize_logfile(
+        pl.concat(
+            [
+                pl.scan_csv(path, separator="\t", infer_schema=False, quote_char=None).with_columns(
+                    pl.lit(session).alias("session")
+                )
+                for session, path in logfiles.items()
+            ],
+            how="diagonal",
+        )
+    )
+
+
+def read_completed_stimuli(logfiles_dir: Path) -> pl.DataFrame:
+    """The stimuli in the order they were shown, from `completed_stimuli.csv`"""
+    return pl.read_csv(
+        logfiles_dir / "completed_stimuli.csv", infer_schema=False
+    ).with_columns(
+        pl.col(column).str.strip_chars().cast(dtype) for column, dtype in COMPLETED_STIMULI_SCHEMA.items()
+    )
+
+
+def normalize_logfile(logfile: pl.LazyFrame) -> pl.LazyFrame:
+    """Cast the IDs to `LOGFILE_SCHEMA` and add the `stimulus_id` of every row
+
+    Rating screens are logged without a stimulus number, they get the one of their trial.
+    `logfile_row` is the row number within the session.
+    """
+    session = ["session"] if "session" in logfile.collect_schema().names() else []
+    return logfile.with_columns(
+        # Empty values and IDs that are not numbers become null
+        pl.col(column).cast(pl.Utf8).str.strip_chars().replace("", None).cast(dtype, strict=False)
+        for column, dtype in LOGFILE_SCHEMA.items()
+    ).with_columns(
+        pl.col("stimulus_number")
+        .fill_null(pl.col("stimulus_number").drop_nulls().first().over(*session, "trial_number"))
+        .alias("stimulus_id"),
+        _over(pl.int_range(pl.len()), session).alias("logfile_row"),
+    )
+
+
+def logfile_screens(logfile: pl.LazyFrame, manifest: pl.DataFrame) -> pl.LazyFrame:
+    """Screens of a normalised logfile, named as in the ASC file
+
+    `page_number` is mapped to the screen name with `stimulus.screen_manifest`; rows that
+    are not in the manifest keep their `page_number` as the screen.
+    """
+    session = ["session"] if "session" in logfile.collect_schema().names() else []
+    return (
+        logfile.filter(pl.col("page_number").is_not_null())
+        .join(manifest.lazy().select("stimulus_id", "stimulus").unique(), on="stimulus_id", how="left")
+        .join(
+            manifest.lazy().select("stimulus", pl.col("logfile_page").alias("page_number"), "screen"),
+            on=["stimulus", "page_number"],
+            how="left",
+        )
+        .with_columns(pl.col("screen").fill_null(pl.col("page_number")))
+        .group_by(*session, "stimulus_id", "stimulus", "screen")
+        .agg(pl.all().sort_by("logfile_row").first())
+    )
+
+
+def asc_screens(messages: pl.LazyFrame) -> pl.LazyFrame:
+    """Start and duration of every recorded screen, from the recording messages"""
+    session = ["session"] if "session" in messages.collect_schema().names() else []
+    return (
+        messages.filter(pl.col("event").is_not_null())
+        .with_columns(
+            # Rating screens belong to the stimulus of their trial
+            pl.col("stimulus").drop_nulls().first().over(*session, "trial").alias("stimulus")
+        )
+        .group_by(*session, "trial", "stimulus", "screen")
+        .agg(
+            pl.col("timestamp").filter(pl.col("event") == "start_recording").min().alias("asc_start"),
+            pl.col("timestamp").filter(pl.col("event") == "stop_recording").max().alias("asc_stop"),
+        )
+        .with_columns(
+            pl.col("stimulus").str.extract(r"_(\d+)$").cast(pl.Int64).alias("stimulus_id"),
+            (pl.col("asc_stop") - pl.col("asc_start")).alias("asc_duration_ms"),
+        )
+    )
+
+
+def reconcile_screens(
+    logfile: pl.LazyFrame,
+    messages: pl.LazyFrame,
+    manifest: pl.DataFrame,
+    timestamp_column: str | None = None,
+) -> pl.LazyFrame:
+    """Every screen of the logfile and of the ASC file side by side
+
+    Both frames can hold many sessions with a `session` column, e.g. from `scan_logfiles`,
+    to reconcile a whole lab in one query. `status` is `both`, `asc_only` or `logfile_only`,
+    and `out_of_order` marks screens that were logged in a different order than they were
+    recorded. If the logfile has the eye tracker time of each row in `timestamp_column`,
+    `time_difference_ms` is the time between the logged row and the start of the recording.
+    """
+    session = ["session"] if "session" in messages.collect_schema().names() else []
+    logged = logfile_screens(logfile, manifest).select(
+        *session,
+        "stimulus_id",
+        "screen",
+        "trial_number",
+        "logfile_row",
+        *([pl.col(timestamp_column).cast(pl.Float64).alias("logfile_timestamp")] if timestamp_column else []),
+    )
+    reconciled = (
+        asc_screens(messages)
+        .join(logged, on=[*session, "stimulus_id", "screen"], how="full", coalesce=True)
+        .with_columns(
+            pl.when(pl.col("asc_start").is_null())
+            .then(pl.lit("logfile_only"))
+            .when(pl.col("logfile_row").is_null())
+            .then(pl.lit("asc_only"))
+            .otherwise(pl.lit("both"))
+            .alias("status")
+        )
+        .sort(*session, "asc_start", "logfile_row", nulls_last=True)
+    )
+    # Following the recording order, the logfile rows of the screens on both sides must increase
+    logged_row = pl.when(pl.col("status") == "both").then(pl.col("logfile_row"))
+    reconciled = reconciled.with_columns(
+        (logged_row < _over(logged_row.cum_max().forward_fill().shift(1), session))
+        .fill_null(False)
+        .alias("out_of_order")
+    )
+    if timestamp_column:
+        reconciled = reconciled.with_columns(
+            (pl.col("logfile_timestamp") - pl.col("asc_start")).alias("time_difference_ms")
+        )
+    return reconciled
+
+
+def _over(expr: pl.Expr, session: list[str]) -> pl.Expr:
+    return expr.over(session) if session else expr
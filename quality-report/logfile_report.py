@@ -6,7 +6,6 @@ from functools import partial
 from glob import glob
 from pathlib import Path
 from typing import Any, Callable, TextIO, Union
-import pandas as pd
 import matplotlib.pyplot as plt
 import PIL
 import polars as pl
@@ -14,10 +13,11 @@ import pymovements as pm
 from matplotlib.patches import Circle
 
 import config
+from logfile import scan_logfiles
 
 
-def load_data(logfile: Path) -> pd.DataFrame:
-    logfile_frame = pd.read_csv(logfile, encoding='utf-8', sep='\t')
+def load_data(logfile: Path) -> pl.DataFrame:
+    logfile_frame = scan_logfiles({logfile.stem: logfile}).collect()
     print(logfile_frame.head())
     return logfile_frame
 
@@ -0,0 +1,244 @@
+import datetime
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import polars as pl
+import pymovements as pm
+
+from compact import components
+
+METRICS_TABLES = ["session", "trial", "screen"]
+SCREEN_COLUMNS = ["trial", "stimulus", "screen"]
+# Bump this whenever the metrics change, so that the sessions are written again
+METRICS_VERSION = 3
+
+
+@dataclass
+class MetricsStore:
+    """Dataset-level store of session, trial and screen metrics
+
+    Every session writes its own Parquet file per table, in Hive-style partition
+    directories (e.g. `screen/lang=zh/country=ch/labnum=1/{session}.parquet`), so that
+    sessions can be written at the same time and rewriting one session does not touch the
+    others. A small SQLite index lists the sessions in the store. Rollups across labs and
+    languages are a single query over `scan(table)`.
+    """
+
+    root: Path
+
+    @property
+    def index_file(self) -> Path:
+        return self.root / "index.sqlite"
+
+    def write(self, session: str, partition: dict[str, str | int], tables: dict[str, pl.DataFrame]) -> None:
+        """Replace the metrics of one session, `partition` are the keys of its directories"""
+        assert set(tables) <= set(METRICS_TABLES), f"Unknown metrics tables {set(tables) - set(METRICS_TABLES)}"
+        partition_dir = Path(*(f"{key}={value}" for key, value in partition.items()))
+        for table, frame in tables.items():
+            path = self.root / table / partition_dir / f"{session}.parquet"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write next to the final file and rename, readers never see a partial file
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            frame.with_columns(pl.lit(session).alias("session")).write_parquet(tmp_path)
+            os.replace(tmp_path, path)
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                (
+                    session,
+                    json.dumps(partition),
+                    json.dumps({table: frame.height for table, frame in tables.items()}),
+                    datetime.datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+
+    def scan(self, table: str) -> pl.LazyFrame:
+        """All sessions of one table, with the partition keys as columns"""
+        assert table in METRICS_TABLES, f"Unknown metrics table {table}, expected one of {METRICS_TABLES}"
+        return pl.scan_parquet(self.root / table / "**" / "*.parquet", hive_partitioning=True)
+
+    def sessions(self) -> pl.DataFrame:
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT session, partition, num_rows, written_at FROM sessions ORDER BY session"
+            ).fetchall()
+        return pl.DataFrame(
+            [
+                {"session": session, **json.loads(partition), "num_rows": num_rows, "written_at": written_at}
+                for session, partition, num_rows, written_at in rows
+            ]
+        )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Concurrent writers wait for each other instead of failing
+        connection = sqlite3.connect(self.index_file, timeout=60)
+        try:
+            with connection:  # Commits, or rolls back on errors
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions "
+                    "(session TEXT PRIMARY KEY, partition TEXT, num_rows TEXT, written_at TEXT)"
+                )
+                yield connection
+        finally:
+            connection.close()
+
+
+def session_metrics(gaze: pm.GazeDataFrame) -> dict[str, pl.DataFrame]:
+    """Session, trial and screen metrics of a preprocessed session"""
+    metadata = gaze._metadata
+    validations = metadata["validations"]
+    fixations = gaze.events.frame.filter(pl.col("name") == "fixation")
+    artifacts = gaze.events.frame.filter(pl.col("name") == "artifact")
+    sampling_interval = 1000 / gaze.experiment.sampling_rate
+    screens = gap_metrics(gaze)
+
+    def by(columns: list[str]) -> pl.DataFrame:
+        fixation_metrics = fixations.group_by(columns).agg(
+            pl.len().alias("num_fixations"),
+            pl.col("duration").mean().cast(pl.Float64).alias("mean_fixation_duration_ms"),
+        )
+        artifact_metrics = artifacts.group_by(columns).agg(
+            pl.len().alias("num_artifacts"),
+            (pl.col("duration") + sampling_interval).sum().cast(pl.Float64).alias("artifact_duration_ms"),
+        )
+        return (
+            rollup_gaps(screens, columns)
+            .join(fixation_metrics, on=columns, how="left")
+            .join(artifact_metrics, on=columns, how="left")
+            .with_columns(
+                pl.col("num_fixations", "num_artifacts").fill_null(0),
+                pl.col("artifact_duration_ms").fill_null(0.0),
+            )
+            .with_columns(
+                (pl.col("artifact_duration_ms") / (pl.col("num_samples") * sampling_interval)).alias(
+                    "artifact_ratio"
+                )
+            )
+            .sort(columns)
+        )
+
+    session = pl.DataFrame(
+        {
+            "sampling_rate": [_float_or_none(metadata["sampling_rate"])],
+            "total_recording_duration_ms": [float(metadata["total_recording_duration_ms"])],
+            "data_loss_ratio": [_float_or_none(metadata["data_loss_ratio"])],
+            "data_loss_ratio_blinks": [_float_or_none(metadata["data_loss_ratio_blinks"])],
+            "num_calibrations": [len(metadata["calibrations"])],
+            "num_validations": [len(validations)],
+            "mean_validation_score_avg": [
+                sum(float(v["validation_score_avg"]) for v in validations) / len(validations)
+                if validations
+                else None
+            ],
+            "num_trials": [gaze.frame.get_column("trial").n_unique()],
+            "num_fixations": [fixations.height],
+        },
+        schema_overrides={
+            column: pl.Float64
+            for column in [
+                "sampling_rate",
+                "data_loss_ratio",
+                "data_loss_ratio_blinks",
+                "mean_validation_score_avg",
+            ]
+        },
+    )
+    return {
+        "session": session,
+        "trial": by(["trial", "stimulus"]),
+        "screen": by(["trial", "stimulus", "screen"]),
+    }
+
+
+def gap_metrics(gaze: pm.GazeDataFrame, by: list[str] = SCREEN_COLUMNS) -> pl.DataFrame:
+    """Data loss and blinks of every screen, from the runs of lost samples
+
+    The samples are run-length encoded in a single pass, everything else is computed on
+    the runs. A gap is a run of samples without a gaze position, it is a blink gap if it
+    overlaps a blink of the ASC file.
+    """
+    sampling_interval = 1000 / gaze.experiment.sampling_rate
+    # Runs never span two screens, since the screen is part of the run key
+    x, _ = components(gaze.frame, "pixel")
+    runs = (
+        gaze.frame.select(*by, pl.col("time").cast(pl.Float64), x.is_nan().fill_null(True).alias("lost"))
+        .group_by(pl.struct(*by, "lost").rle_id().alias("run"), maintain_order=True)
+        .agg(
+            *(pl.col(column).first() for column in [*by, "lost"]),
+            pl.col("time").first().alias("start"),
+            pl.col("time").last().alias("end"),
+            pl.len().alias("num_samples"),
+        )
+        .with_columns((pl.col("end") - pl.col("start") + sampling_interval).alias("duration_ms"))
+    )
+    blinks = pl.DataFrame(
+        gaze._metadata["blinks"],
+        schema={"start_timestamp": pl.Float64, "stop_timestamp": pl.Float64},
+    ).sort("start_timestamp")
+    runs = runs.sort("end").join_asof(blinks, left_on="end", right_on="start_timestamp").with_columns(
+        (pl.col("lost") & (pl.col("stop_timestamp") >= pl.col("start"))).fill_null(False).alias("blink")
+    )
+
+    screens = runs.group_by(by).agg(
+        pl.col("start").min(),
+        pl.col("end").max(),
+        pl.col("num_samples").sum(),
+        pl.col("num_samples").filter(pl.col("lost")).sum().alias("num_lost_samples"),
+        pl.col("num_samples").filter(pl.col("blink")).sum().alias("num_blink_samples"),
+        pl.col("lost").sum().cast(pl.Int64).alias("num_gaps"),
+        pl.col("duration_ms").filter(pl.col("lost")).max().fill_null(0.0).alias("longest_gap_ms"),
+        pl.col("duration_ms").filter(pl.col("lost")).sum().alias("total_gap_ms"),
+    )
+    # Blinks are counted on the screen during which they started
+    num_blinks = (
+        blinks.join_asof(
+            screens.select(*by, "start", "end").sort("start"),
+            left_on="start_timestamp",
+            right_on="start",
+        )
+        .filter(pl.col("start_timestamp") <= pl.col("end"))
+        .group_by(by)
+        .agg(pl.len().cast(pl.Int64).alias("num_blinks"))
+    )
+    return (
+        screens.join(num_blinks, on=by, how="left")
+        .with_columns(
+            pl.col("num_blinks").fill_null(0),
+            (pl.col("end") - pl.col("start")).alias("duration_ms"),
+            (pl.col("num_lost_samples") / pl.col("num_samples")).alias("data_loss_ratio"),
+            (pl.col("num_blink_samples") / pl.col("num_samples")).alias("data_loss_ratio_blinks"),
+        )
+        .drop("start", "end")
+        # The keys are categorical in the compact layout, see `compact.compact_samples`
+        .with_columns(pl.col(by).cast(pl.Utf8))
+        .sort(by)
+    )
+
+
+def rollup_gaps(screens: pl.DataFrame, by: list[str]) -> pl.DataFrame:
+    """Gap metrics of `gap_metrics` for coarser groups, e.g. per trial"""
+    return (
+        screens.group_by(by)
+        .agg(
+            pl.col("num_samples", "num_lost_samples", "num_blink_samples", "num_gaps", "num_blinks").sum(),
+            pl.col("longest_gap_ms").max(),
+            pl.col("total_gap_ms", "duration_ms").sum(),
+        )
+        .with_columns(
+            (pl.col("num_lost_samples") / pl.col("num_samples")).alias("data_loss_ratio"),
+            (pl.col("num_blink_samples") / pl.col("num_samples")).alias("data_loss_ratio_blinks"),
+        )
+    )
+
+
+def _float_or_none(value: float | str) -> float | None:
+    # Unknown values are stored as "unknown" in the metadata
+    return float(value) if not isinstance(value, str) else None
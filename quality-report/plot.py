@@ -1,56 +1,47 @@
 import argparse
 import importlib
 import math
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Collection
 
 import matplotlib.pyplot as plt
+import numpy as np
 import PIL
+import PIL.ImageDraw
 import polars as pl
 import pymovements as pm
+from artifacts import detect_artifacts
+from asc import TRIAL_COLUMNS, AscSession, scan_asc
+from compact import components
+from event_properties import add_event_properties
 from matplotlib.patches import Circle
 from stimulus import LabConfig, Stimulus, load_stimuli
 
 
-def load_data(asc_file: Path, lab_config: LabConfig) -> pm.GazeDataFrame:
-    gaze = pm.gaze.from_asc(
-        asc_file,
-        patterns=[
-            r"start_recording_(?P<trial>(?:PRACTICE_)?trial_\d+)_stimulus_(?P<stimulus>[^_]+_[^_]+_\d+)_(?P<screen>.+)",
-            r"start_recording_(?P<trial>(?:PRACTICE_)?trial_\d+)_(?P<screen>familiarity_rating_screen_\d+|subject_difficulty_screen)",
-            {"pattern": r"stop_recording_", "column": "trial", "value": None},
-            {"pattern": r"stop_recording_", "column": "screen", "value": None},
-            {
-                "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_stimulus_[^_]+_[^_]+_\d+_page_\d+",
-                "column": "activity",
-                "value": "reading",
-            },
-            {
-                "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_stimulus_[^_]+_[^_]+_\d+_question_\d+",
-                "column": "activity",
-                "value": "question",
-            },
-            {
-                "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_(familiarity_rating_screen_\d+|subject_difficulty_screen)",
-                "column": "activity",
-                "value": "rating",
-            },
-            {"pattern": r"stop_recording_", "column": "activity", "value": None},
-            {
-                "pattern": r"start_recording_PRACTICE_trial_",
-                "column": "practice",
-                "value": True,
-            },
-            {
-                "pattern": r"start_recording_trial_",
-                "column": "practice",
-                "value": False,
-            },
-            {"pattern": r"stop_recording_", "column": "practice", "value": None},
-        ],
-        trial_columns=["trial", "stimulus", "screen"],
-    )
+def load_data(
+        asc_file: Path,
+        lab_config: LabConfig,
+        session: AscSession | None = None,
+        stimuli: Collection[str] | None = None,
+        columns: list[str] | None = None,
+) -> pm.GazeDataFrame:
+    """Gaze samples of the trials, optionally only of `stimuli` and only with `columns`
+
+    When the ASC file is scanned here, the samples outside of the selected trials are
+    skipped by the scanner and only `columns` are built, see `asc.scan_asc`.
+    """
+    if columns is not None:
+        # The trials are filtered below and the pixels are preprocessed
+        missing = [column for column in ["x_pix", "y_pix", *TRIAL_COLUMNS] if column not in columns]
+        if missing:
+            raise ValueError(f"load_data needs the sample columns {missing}, got {columns}")
+    # Reuse an already scanned session so that the ASC file is only read once
+    if session is None:
+        session = scan_asc(asc_file, trials_only=True, stimuli=stimuli, columns=columns)
+    gaze = session.to_gaze()
 
-    # Filter out data outside of trials
+    # Filter out data outside of trials, for sessions that were scanned without `trials_only`
     # TODO: Also report time spent outside of trials
     gaze.frame = gaze.frame.filter(
         pl.col("trial").is_not_null() & pl.col("screen").is_not_null()
@@ -76,9 +67,96 @@ def load_data(asc_file: Path, lab_config: LabConfig) -> pm.GazeDataFrame:
     return gaze
 
 
+# Event properties as (property, kwargs, event name), see `event_properties.PROPERTIES`.
+# The duration is already added by the event detection.
+EVENT_PROPERTIES = [
+    ("location", dict(position_column="pixel"), "fixation"),
+    ("dispersion", dict(), "fixation"),
+    ("amplitude", dict(), "saccade"),
+    ("peak_velocity", dict(), "saccade"),
+    ("mean_velocity", dict(), None),
+    ("start_position", dict(position_column="pixel"), None),
+    ("end_position", dict(position_column="pixel"), None),
+]
+# Event names in the order in which `preprocess` detects them
+DETECTED_EVENTS = ["fixation", "saccade", "artifact"]
+# Original position of the samples, while pymovements may reorder them
+SAMPLE_ORDER_COLUMN = "sample_order"
+
+
 def preprocess(
-        gaze: pm.GazeDataFrame, sg_window_length: int = 50, sg_degree: int = 2
+        gaze: pm.GazeDataFrame,
+        sg_window_length: int = 50,
+        sg_degree: int = 2,
+        partition_by: list[str] | None = None,
 ) -> None:
+    """Compute velocities, detect events and compute the event properties
+
+    With `partition_by` (a subset of the trial columns), the samples of one partition
+    are processed at a time, so that the memory usage is bounded by the largest
+    partition instead of the whole session. The result is the same. Either way, the
+    samples keep their order, also when a screen was recorded twice with other screens
+    in between (pymovements would move them next to each other).
+    """
+    if partition_by is None:
+        gaze.frame = gaze.frame.with_row_index(SAMPLE_ORDER_COLUMN)
+        _preprocess(gaze, sg_window_length, sg_degree)
+        gaze.frame = gaze.frame.sort(SAMPLE_ORDER_COLUMN).drop(SAMPLE_ORDER_COLUMN)
+        return
+    assert set(partition_by) <= set(gaze.trial_columns), (
+        f"Can only partition by the trial columns {gaze.trial_columns}, got {partition_by}"
+    )
+
+    # pymovements processes the trials in the order of their first sample, so we do too
+    partitions = (
+        gaze.frame.select(partition_by)
+        .with_row_index("row")
+        .group_by(partition_by, maintain_order=True)
+        .agg("row")
+        .get_column("row")
+    )
+    frames = []
+    event_frames = []
+    for rows in partitions:
+        partition = _partition_gaze(gaze, gaze.frame[rows])
+        _preprocess(partition, sg_window_length, sg_degree)
+        frames.append(partition.frame)
+        event_frames.append(partition.events.frame)
+        del partition
+
+    # Back to the order of the samples, the partitions are not always contiguous
+    gaze.frame = pl.concat(frames)[partitions.explode().arg_sort()]
+    events = pl.concat(event_frames, how="diagonal_relaxed")
+    # Each detection appends its events for all trials, so the events of the whole
+    # session are ordered by detection first and by trial second
+    events = events.sort(
+        pl.col("name").replace_strict(
+            DETECTED_EVENTS, range(len(DETECTED_EVENTS)), default=len(DETECTED_EVENTS)
+        ),
+        maintain_order=True,
+    )
+    columns = gaze.trial_columns + ["name", "onset", "offset", "duration"]
+    columns += [property for property, _, _ in EVENT_PROPERTIES]
+    gaze.events.frame = events.select(
+        [column for column in columns if column in events.columns]
+        + [column for column in events.columns if column not in columns]
+    )
+
+
+def _partition_gaze(gaze: pm.GazeDataFrame, frame: pl.DataFrame) -> pm.GazeDataFrame:
+    # Assigned after construction as GazeDataFrame would otherwise copy and convert the frame again
+    partition = pm.GazeDataFrame(experiment=gaze.experiment)
+    partition.frame = frame
+    partition.trial_columns = gaze.trial_columns
+    partition.n_components = gaze.n_components
+    partition.events = pm.EventDataFrame(
+        pl.DataFrame(schema={column: frame.schema[column] for column in gaze.trial_columns}),
+        trial_columns=gaze.trial_columns,
+    )
+    return partition
+
+
+def _preprocess(gaze: pm.GazeDataFrame, sg_window_length: int, sg_degree: int) -> None:
     # Savitzky-Golay filter as in https://doi.org/10.3758/BRM.42.1.188
     window_length = round(gaze.experiment.sampling_rate / 1000 * sg_window_length)
     if window_length % 2 == 0:  # Must be odd
@@ -87,171 +165,189 @@ def preprocess(
     gaze.pos2vel("savitzky_golay", window_length=window_length, degree=sg_degree)
     gaze.detect("ivt")
     gaze.detect("microsaccades")
-    for property, kwargs, event_name in [
-        ("location", dict(position_column="pixel"), "fixation"),
-        ("amplitude", dict(), "saccade"),
-        ("peak_velocity", dict(), "saccade"),
-    ]:
-        processor = pm.EventGazeProcessor((property, kwargs))
-        new_properties = processor.process(
-            gaze.events,
-            gaze,
-            identifiers=gaze.trial_columns,
-            name=event_name,
-        )
-        join_on = gaze.trial_columns + ["name", "onset", "offset"]
-        gaze.events.add_event_properties(new_properties, join_on=join_on)
-    # TODO: AOI mapping
+    detect_artifacts(gaze)
+    add_event_properties(gaze, EVENT_PROPERTIES)
+    # AOI mapping needs the stimuli, see `aoi.map_event_aois`
 
 
-def plot_gaze(gaze: pm.GazeDataFrame, stimulus: Stimulus, plots_dir: Path) -> None:
-    for page in stimulus.pages:
-        screen_gaze = gaze.frame.filter(
-            (pl.col("stimulus") == f"{stimulus.name}_{stimulus.id}")
-            & (pl.col("screen") == f"page_{page.number}")
-        ).select(
-            pl.col("pixel").list.get(0).alias("pixel_x"),
-            pl.col("pixel").list.get(1).alias("pixel_y"),
-        )
-        page_events = gaze.events.frame.filter(
-            (pl.col("stimulus") == f"{stimulus.name}_{stimulus.id}")
-            & (pl.col("screen") == f"page_{page.number}")
-            & (pl.col("name") == "fixation")
-        ).select(
+@dataclass
+class Screens:
+    """Gaze samples and fixations of a session, split once by (stimulus, screen)"""
+
+    samples: dict[tuple[str, str], pl.DataFrame]
+    fixations: dict[tuple[str, str], pl.DataFrame]
+
+    @classmethod
+    def split(cls, gaze: pm.GazeDataFrame) -> "Screens":
+        x, y = components(gaze.frame, "pixel")
+        samples = gaze.frame.select("stimulus", "screen", x.alias("pixel_x"), y.alias("pixel_y"))
+        fixations = gaze.events.frame.filter(pl.col("name") == "fixation").select(
+            "stimulus",
+            "screen",
             pl.col("duration"),
             pl.col("location").list.get(0).alias("pixel_x"),
             pl.col("location").list.get(1).alias("pixel_y"),
         )
-
-        fig, ax = plt.subplots()
-        stimulus_image = PIL.Image.open(page.image_path)
-        ax.imshow(stimulus_image)
-
-        # Plot raw gaze data
-        plt.plot(
-            screen_gaze["pixel_x"],
-            screen_gaze["pixel_y"],
-            color="black",
-            linewidth=0.5,
-            alpha=0.3,
+        return cls(
+            samples=samples.partition_by(["stimulus", "screen"], as_dict=True, include_key=False),
+            fixations=fixations.partition_by(["stimulus", "screen"], as_dict=True, include_key=False),
         )
 
-        # Plot fixations
-        for row in page_events.iter_rows(named=True):
-            fixation = Circle(
-                (row["pixel_x"], row["pixel_y"]),
-                math.sqrt(row["duration"]),
-                color="blue",
-                fill=True,
-                alpha=0.5,
-                zorder=10,
+    def get(self, stimulus: str, screen: str) -> tuple[pl.DataFrame, pl.DataFrame]:
+        samples = self.samples.get((stimulus, screen))
+        if samples is None:
+            samples = pl.DataFrame(schema={"pixel_x": pl.Float64, "pixel_y": pl.Float64})
+        fixations = self.fixations.get((stimulus, screen))
+        if fixations is None:
+            fixations = pl.DataFrame(
+                schema={"duration": pl.Float64, "pixel_x": pl.Float64, "pixel_y": pl.Float64}
             )
-            ax.add_patch(fixation)
-        ax.set_xlim((0, gaze.experiment.screen.width_px))
-        ax.set_ylim((gaze.experiment.screen.height_px, 0))
-        fig.savefig(plots_dir / f"{stimulus.name}_{page.number}.png")
-        plt.close(fig)
+        return samples, fixations
+
+
+def plot_gaze(
+        gaze: pm.GazeDataFrame,
+        stimulus: Stimulus,
+        plots_dir: Path,
+        screens: Screens | None = None,
+        backend: str = "raster",
+) -> None:
+    """Plot the gaze samples and fixations on every screen of a stimulus
+
+    The "raster" backend draws directly onto the stimulus images and is much faster,
+    "matplotlib" produces the same plots as figures.
+    """
+    assert backend in PLOT_BACKENDS, f"Unknown plot backend {backend}, expected one of {list(PLOT_BACKENDS)}"
+    plot_screen = PLOT_BACKENDS[backend]
+    # Split the session once with `Screens.split` when plotting several stimuli
+    if screens is None:
+        screens = Screens.split(gaze)
+    stimulus_key = f"{stimulus.name}_{stimulus.id}"
+
+    for page in stimulus.pages:
+        plot_screen(
+            gaze,
+            *screens.get(stimulus_key, f"page_{page.number}"),
+            page.image_path,
+            plots_dir / f"{stimulus.name}_{page.number}.png",
+        )
 
     for question in stimulus.questions:
         screen_name = (
             f"question_{int(question.id)}"  # Screen names don't have leading zeros
         )
-        screen_gaze = gaze.frame.filter(
-            (pl.col("stimulus") == f"{stimulus.name}_{stimulus.id}")
-            & (pl.col("screen") == screen_name)
-        ).select(
-            pl.col("pixel").list.get(0).alias("pixel_x"),
-            pl.col("pixel").list.get(1).alias("pixel_y"),
-        )
-        page_events = gaze.events.frame.filter(
-            (pl.col("stimulus") == f"{stimulus.name}_{stimulus.id}")
-            & (pl.col("screen") == screen_name)
-            & (pl.col("name") == "fixation")
-        ).select(
-            pl.col("duration"),
-            pl.col("location").list.get(0).alias("pixel_x"),
-            pl.col("location").list.get(1).alias("pixel_y"),
+        plot_screen(
+            gaze,
+            *screens.get(stimulus_key, screen_name),
+            question.image_path,
+            plots_dir / f"{stimulus.name}_q{question.id}.png",
         )
 
-        fig, ax = plt.subplots()
-        question_image = PIL.Image.open(question.image_path)
-        ax.imshow(question_image)
-
-        # Plot raw gaze data
-        plt.plot(
-            screen_gaze["pixel_x"],
-            screen_gaze["pixel_y"],
-            color="black",
-            linewidth=0.5,
-            alpha=0.3,
+    for rating in stimulus.ratings:
+        # Rating screens keep the stimulus of the pages before them
+        plot_screen(
+            gaze,
+            *screens.get(stimulus_key, rating.name),
+            rating.image_path,
+            plots_dir / f"{stimulus.name}_{stimulus.id}_{rating.name}.png",
         )
 
-        # Plot fixations
-        for row in page_events.iter_rows(named=True):
-            fixation = Circle(
-                (row["pixel_x"], row["pixel_y"]),
-                math.sqrt(row["duration"]),
-                color="blue",
-                fill=True,
-                alpha=0.5,
-                zorder=10,
-            )
-            ax.add_patch(fixation)
-        ax.set_xlim((0, gaze.experiment.screen.width_px))
-        ax.set_ylim((gaze.experiment.screen.height_px, 0))
-        fig.savefig(plots_dir / f"{stimulus.name}_q{question.id}.png")
-        plt.close(fig)
 
-    for rating in stimulus.ratings:
-        screen_name = (
-            f"{rating.name}"  # Screen names don't have leading zeros
-        )
-        screen_gaze = gaze.frame.filter(
-            (pl.col("trial") == f"trial_{stimulus.id}")
-            & (pl.col("screen") == screen_name)
-        ).select(
-            pl.col("pixel").list.get(0).alias("pixel_x"),
+def _plot_screen_matplotlib(
+        gaze: pm.GazeDataFrame,
+        screen_gaze: pl.DataFrame,
+        fixations: pl.DataFrame,
+        image_path: Path,
+        plot_path: Path,
+) -> None:
+    fig, ax = plt.subplots()
+    stimulus_image = PIL.Image.open(image_path)
+    ax.imshow(stimulus_image)
 
-            pl.col("pixel").list.get(1).alias("pixel_y"),
-        )
-        page_events = gaze.events.frame.filter(
-            (pl.col("stimulus") == f"trial_{stimulus.id}")
-            & (pl.col("screen") == screen_name)
-            & (pl.col("name") == "fixation")
-        ).select(
-            pl.col("duration"),
-            pl.col("location").list.get(0).alias("pixel_x"),
-            pl.col("location").list.get(1).alias("pixel_y"),
-        )
+    # Plot raw gaze data
+    plt.plot(
+        screen_gaze["pixel_x"],
+        screen_gaze["pixel_y"],
+        color="black",
+        linewidth=0.5,
+        alpha=0.3,
+    )
 
-        fig, ax = plt.subplots()
-        rating_image = PIL.Image.open(rating.image_path)
-        ax.imshow(rating_image)
-
-        # Plot raw gaze data
-        plt.plot(
-            screen_gaze["pixel_x"],
-            screen_gaze["pixel_y"],
-            color="black",
-            linewidth=0.5,
-            alpha=0.3,
+    # Plot fixations
+    for row in fixations.iter_rows(named=True):
+        fixation = Circle(
+            (row["pixel_x"], row["pixel_y"]),
+            math.sqrt(row["duration"]),
+            color="blue",
+            fill=True,
+            alpha=0.5,
+            zorder=10,
         )
+        ax.add_patch(fixation)
+    ax.set_xlim((0, gaze.experiment.screen.width_px))
+    ax.set_ylim((gaze.experiment.screen.height_px, 0))
+    fig.savefig(plot_path)
+    plt.close(fig)
+
+
+def _plot_screen_raster(
+        gaze: pm.GazeDataFrame,
+        screen_gaze: pl.DataFrame,
+        fixations: pl.DataFrame,
+        image_path: Path,
+        plot_path: Path,
+) -> None:
+    # Same plot as `_plot_screen_matplotlib`, but drawn directly onto the stimulus image
+    width, height = gaze.experiment.screen.width_px, gaze.experiment.screen.height_px
+    canvas = PIL.Image.new("RGB", (width, height), "white")
+    with PIL.Image.open(image_path) as stimulus_image:
+        canvas.paste(stimulus_image.convert("RGB"), (0, 0))
+
+    # Plot raw gaze data, drawn at a higher resolution and scaled down for anti-aliasing
+    trace = PIL.Image.new("L", (width * RASTER_SUPERSAMPLING, height * RASTER_SUPERSAMPLING), 0)
+    draw = PIL.ImageDraw.Draw(trace)
+    points = screen_gaze.select("pixel_x", "pixel_y").to_numpy() * RASTER_SUPERSAMPLING
+    valid = np.isfinite(points).all(axis=1)
+    # Like matplotlib, the line is interrupted at missing samples
+    for segment in np.split(points, np.flatnonzero(np.diff(valid.astype(np.int8))) + 1):
+        if len(segment) > 1 and np.isfinite(segment).all():
+            draw.line(segment.ravel().tolist(), fill=round(0.3 * 255), width=RASTER_SUPERSAMPLING)
+    trace = trace.reduce(RASTER_SUPERSAMPLING)
+    canvas.paste((0, 0, 0), mask=trace)
+    pixels = np.array(canvas)
+
+    # Plot fixations, each disk is blended over the previous ones. The disks are drawn one
+    # at a time on purpose: every iteration is a numpy operation over the window of its
+    # disk, while stamping all disks at once (per radius bucket, summed with np.add.at or
+    # np.bincount) has a fixed cost over the whole image and was slower for 10 to 1000
+    # fixations per screen.
+    blue = np.array([0, 0, 255], dtype=np.float32)
+    for x, y, duration in fixations.select("pixel_x", "pixel_y", "duration").iter_rows():
+        if x is None or y is None or not (math.isfinite(x) and math.isfinite(y)):
+            continue
+        radius = math.sqrt(duration)
+        x0, x1 = max(0, math.floor(x - radius)), min(width, math.ceil(x + radius) + 1)
+        y0, y1 = max(0, math.floor(y - radius)), min(height, math.ceil(y + radius) + 1)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        distance = np.sqrt((xx + 0.5 - x) ** 2 + (yy + 0.5 - y) ** 2)
+        alpha = 0.5 * np.clip(radius + 0.5 - distance, 0, 1)[..., np.newaxis]
+        window = pixels[y0:y1, x0:x1]
+        pixels[y0:y1, x0:x1] = np.round(window * (1 - alpha) + blue * alpha)
+
+    # Fast compression, the plots are written by the thousands
+    PIL.Image.fromarray(pixels).save(plot_path, compress_level=1)
+
+
+PLOT_BACKENDS = {
+    "raster": _plot_screen_raster,
+    "matplotlib": _plot_screen_matplotlib,
+}
+# Factor by which the gaze trace is oversampled in the raster backend
+RASTER_SUPERSAMPLING = 2
+
 
-        # Plot fixations
-        for row in page_events.iter_rows(named=True):
-            fixation = Circle(
-                (row["pixel_x"], row["pixel_y"]),
-                math.sqrt(row["duration"]),
-                color="blue",
-                fill=True,
-                alpha=0.5,
-                zorder=10,
-            )
-            ax.add_patch(fixation)
-        ax.set_xlim((0, gaze.experiment.screen.width_px))
-        ax.set_ylim((gaze.experiment.screen.height_px, 0))
-        fig.savefig(plots_dir / f"{stimulus.name}_{stimulus.id}_{rating.name}.png")
-        plt.close(fig)
 def plot_main_sequence(events: pm.EventDataFrame, plots_dir: Path) -> None:
     pm.plotting.main_sequence_plot(
         events, show=False, savepath=plots_dir / "main_sequence.png"
@@ -268,6 +364,12 @@ if __name__ == "__main__":
     )
 
     parser.add_argument("--plots-dir", type=Path, required=True, help="Path to save the plots")
+    parser.add_argument(
+        "--backend",
+        choices=list(PLOT_BACKENDS),
+        default="raster",
+        help="Draw directly onto the stimulus images (fast) or with matplotlib",
+    )
     args = parser.parse_args()
 
     print("Loading data...")
@@ -282,7 +384,8 @@ if __name__ == "__main__":
         lab_config,
     )
     print("Preprocessing...")
-    preprocess(gaze)
+    preprocess(gaze, partition_by=gaze.trial_columns)
+    screens = Screens.split(gaze)
     for stimulus in stimuli:
         print(f"Plotting {stimulus.name}...")
-        plot_gaze(gaze, stimulus, args.plots_dir)
+        plot_gaze(gaze, stimulus, args.plots_dir, screens, backend=args.backend)
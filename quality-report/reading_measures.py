@@ -0,0 +1,147 @@
+from pathlib import Path
+
+import polars as pl
+import pymovements as pm
+
+from aoi import AoiMapper
+from asc import TRIAL_COLUMNS
+from stimulus import Stimulus
+
+MEASURES = ["ffd", "gd", "tft", "fpr", "rpd", "skip"]
+
+
+def reading_measures(
+    fixations: pl.DataFrame,
+    by: list[str] = TRIAL_COLUMNS,
+    aoi_column: str = "token_aoi_id",
+    tokens: pl.DataFrame | None = None,
+) -> pl.DataFrame:
+    """Compute the reading measures of every AOI, for all screens (`by`) at once
+
+    - ffd: first-fixation duration, the first fixation on the AOI in first-pass reading
+    - gd: gaze duration, the sum of the first-pass fixations on the AOI
+    - tft: total fixation time
+    - fpr: first-pass regression, whether the first pass ended with a regression
+    - rpd: regression-path duration, from entering the AOI in first pass until moving past it
+    - skip: whether the AOI was not fixated in first-pass reading
+
+    First-pass reading of an AOI is the first run of fixations on it, if no AOI further in
+    the text was fixated before. First-pass measures are null for skipped AOIs. The AOI ids
+    must increase in reading order. Fixations outside of the AOIs are ignored. Add a
+    session column to `by` to process many sessions at once. With `tokens` (the `by`
+    columns and `aoi_column`), AOIs that were never fixated are included as skipped.
+    """
+    fixations = (
+        fixations.filter(pl.col(aoi_column).is_not_null())
+        .select(*by, "onset", "duration", pl.col(aoi_column).alias("aoi"))
+        .sort(*by, "onset")
+        # Number the screens once, the windows and joins below are much faster on one integer
+        .with_columns(
+            pl.any_horizontal(pl.col(column).ne_missing(pl.col(column).shift(1)) for column in by)
+            .cum_sum()
+            .alias("screen_id")
+        )
+        .with_columns(
+            # Fixation duration before this fixation, and highest AOI fixated up to here
+            (pl.col("duration").cum_sum() - pl.col("duration")).over("screen_id").alias("time_before"),
+            pl.col("aoi").cum_max().over("screen_id").alias("max_aoi"),
+            pl.col("aoi").shift(1).over("screen_id").alias("previous_aoi"),
+            pl.col("aoi").shift(-1).over("screen_id").alias("next_aoi"),
+        )
+        .with_columns(
+            pl.col("max_aoi").shift(1).over("screen_id").alias("previous_max_aoi"),
+            (pl.col("aoi") != pl.col("previous_aoi")).fill_null(True).alias("run_start"),
+            (pl.col("aoi") != pl.col("next_aoi")).fill_null(True).alias("run_end"),
+        )
+        .with_columns(pl.col("run_start").cum_sum().over("screen_id").alias("run"))
+        .with_columns(
+            # Only the first run on an AOI can start before anything further was fixated
+            (pl.col("previous_max_aoi") < pl.col("aoi"))
+            .fill_null(True)
+            .first()
+            .over("screen_id", "run")
+            .alias("first_pass")
+        )
+    )
+
+    # The regression path ends with the first fixation beyond the AOI. The highest fixated
+    # AOI never decreases, so that fixation is found with an as-of join on it.
+    path_ends = (
+        fixations.filter(pl.col("max_aoi") > pl.col("previous_max_aoi").fill_null(-1))
+        .select("screen_id", pl.col("max_aoi").alias("path_end_aoi"), pl.col("time_before").alias("path_end"))
+    )
+    first_pass_starts = (
+        fixations.filter(pl.col("first_pass") & pl.col("run_start"))
+        .select("screen_id", "aoi", "time_before", (pl.col("aoi") + 1).alias("next_aoi_min"))
+        .sort("next_aoi_min")
+        .join_asof(
+            path_ends.sort("path_end_aoi"),
+            left_on="next_aoi_min",
+            right_on="path_end_aoi",
+            by="screen_id",
+            strategy="forward",
+        )
+        .join(
+            fixations.group_by("screen_id").agg(pl.col("duration").sum().alias("screen_duration")),
+            on="screen_id",
+            how="left",
+        )
+        .select(
+            "screen_id",
+            "aoi",
+            (pl.col("path_end").fill_null(pl.col("screen_duration")) - pl.col("time_before")).alias("rpd"),
+        )
+    )
+
+    # Simple aggregations only, conditional ones inside the groups are much slower
+    measures = (
+        fixations.with_columns(
+            pl.when(pl.col("first_pass") & pl.col("run_start")).then("duration").alias("ffd"),
+            pl.when("first_pass").then("duration").alias("gd"),
+            (pl.col("first_pass") & pl.col("run_end") & (pl.col("next_aoi") < pl.col("aoi")))
+            .fill_null(False)
+            .alias("fpr"),
+        )
+        .group_by("screen_id", "aoi")
+        .agg(
+            *[pl.col(column).first() for column in by],
+            pl.col("ffd").max(),
+            pl.col("gd").sum(),
+            pl.col("duration").sum().alias("tft"),
+            # max instead of any, which is slow in aggregations
+            pl.col("fpr").max(),
+            pl.col("first_pass").max().not_().alias("skip"),
+        )
+        .with_columns(
+            pl.when(pl.col("skip").not_()).then(pl.col(measure)).alias(measure)
+            for measure in ["gd", "fpr"]
+        )
+        .join(first_pass_starts, on=["screen_id", "aoi"], how="left")
+    )
+    if tokens is not None:
+        measures = (
+            tokens.select(*by, pl.col(aoi_column).alias("aoi"))
+            .unique()
+            .join(measures, on=[*by, "aoi"], how="left")
+            .with_columns(pl.col("tft").fill_null(0), pl.col("skip").fill_null(True))
+        )
+    return measures.sort(*by, "aoi").select(*by, pl.col("aoi").alias(aoi_column), *MEASURES)
+
+
+def write_reading_measures(
+    events: pm.EventDataFrame, stimuli: list[Stimulus], output_dir: Path, participant_id: str
+) -> list[Path]:
+    """Write the token measures of every stimulus to `{participant_id}_{stimulus}_measures.csv`
+
+    The events need the AOIs of `aoi.map_event_aois`. Every stimulus is shown in one
+    trial, so the measures are computed by stimulus and screen (README step 3).
+    """
+    by = ["stimulus", "screen"]
+    fixations = events.frame.filter(pl.col("name") == "fixation").with_columns(pl.col(by).cast(pl.Utf8))
+    measures = reading_measures(fixations, by=by, tokens=AoiMapper.from_stimuli(stimuli).tokens())
+    paths = []
+    for (stimulus,), stimulus_measures in measures.partition_by("stimulus", as_dict=True).items():
+        path = output_dir / f"{participant_id}_{stimulus}_measures.csv"
+        stimulus_measures.drop("stimulus").write_csv(path)
+        paths.append(path)
+    return paths
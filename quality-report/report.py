@@ -14,46 +14,28 @@ import pymovements as pm
 from matplotlib.patches import Circle
 
 import config
-
-
-def load_data(asc_file: Path, stimulus_dir: Path, config: Path) -> pm.GazeDataFrame:
-    gaze = pm.gaze.from_asc(
-        asc_file,
-        patterns=[
-            r"start_recording_(?P<trial>(?:PRACTICE_)?trial_\d+)_stimulus_(?P<stimulus>[^_]+_[^_]+_\d+)_(?P<screen>.+)",
-            r"start_recording_(?P<trial>(?:PRACTICE_)?trial_\d+)_(?P<screen>familiarity_rating_screen_\d+|subject_difficulty_screen)",
-            {"pattern": r"stop_recording_", "column": "trial", "value": None},
-            {"pattern": r"stop_recording_", "column": "screen", "value": None},
-            {
-                "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_stimulus_[^_]+_[^_]+_\d+_page_\d+",
-                "column": "activity",
-                "value": "reading",
-            },
-            {
-                "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_stimulus_[^_]+_[^_]+_\d+_question_\d+",
-                "column": "activity",
-                "value": "question",
-            },
-            {
-                "pattern": r"start_recording_(?:PRACTICE_)?trial_\d+_(familiarity_rating_screen_\d+|subject_difficulty_screen)",
-                "column": "activity",
-                "value": "rating",
-            },
-            {"pattern": r"stop_recording_", "column": "activity", "value": None},
-            {
-                "pattern": r"start_recording_PRACTICE_trial_",
-                "column": "practice",
-                "value": True,
-            },
-            {
-                "pattern": r"start_recording_trial_",
-                "column": "practice",
-                "value": False,
-            },
-            {"pattern": r"stop_recording_", "column": "practice", "value": None},
-        ],
-        trial_columns=["trial", "stimulus", "screen"],
-    )
+from aoi import fixation_locations
+from asc import AscScanner, AscSession, scan_asc
+from completeness import observed_screens_asc, observed_screens_logfile, screen_completeness
+from flow import EXPERIMENT_FLOW, FlowAutomaton
+from follow import follow_asc
+from logfile import normalize_logfile
+from metrics import gap_metrics, rollup_gaps, session_metrics
+from plot import preprocess
+from stimulus import Stimulus, load_stimuli
+from timeline import Timeline
+
+
+def load_data(
+    asc_file: Path,
+    stimulus_dir: Path,
+    config: Path,
+    session: AscSession | None = None,
+) -> pm.GazeDataFrame:
+    # Reuse an already scanned session so that the ASC file is only read once
+    if session is None:
+        session = scan_asc(asc_file, trials_only=True)
+    gaze = session.to_gaze()
 
     # Filter out data outside of trials
     # TODO: Also report time spent outside of trials
@@ -159,10 +141,11 @@ def check_metadata(metadata: dict[str, Any], report: ReportFunction) -> None:
         config.ACCEPTABLE_DATA_LOSS_RATIOS,
         percentage=True,
     )
-    total_recording_duration = metadata["total_recording_duration_ms"] / 60000
+    # The acceptable durations are in seconds
+    total_recording_duration = round(metadata["total_recording_duration_ms"] / 1000, 2)
     report(
-        "Total recording duration",
-        f"{total_recording_duration:.2f} min",
+        "Total recording duration (s)",
+        total_recording_duration,
         config.ACCEPTABLE_RECORDING_DURATIONS,
     )
     sampling_rate = metadata["sampling_rate"]
@@ -189,36 +172,208 @@ def check_gaze(gaze: pm.GazeDataFrame, report: ReportFunction) -> None:
     # TODO: All trials present, all pages, questions and ratings present, plausible reading times etc.
 
 
-def preprocess(gaze: pm.GazeDataFrame) -> None:
-    # Savitzky-Golay filter as in https://doi.org/10.3758/BRM.42.1.188
-    window_length = round(
-        gaze.experiment.sampling_rate / 1000 * config.SG_WINDOW_LENGTH
-    )
-    if window_length % 2 == 0:  # Must be odd
-        window_length += 1
-    gaze.pix2deg()
-    gaze.pos2vel("savitzky_golay", window_length=window_length, degree=config.SG_DEGREE)
-    gaze.detect("ivt")
-    gaze.detect("microsaccades")
-    for property, kwargs, event_name in [
-        ("location", dict(position_column="pixel"), "fixation"),
-        ("amplitude", dict(), "saccade"),
-        ("peak_velocity", dict(), "saccade"),
-    ]:
-        processor = pm.EventGazeProcessor((property, kwargs))
-        new_properties = processor.process(
-            gaze.events,
-            gaze,
-            identifiers=gaze.trial_columns,
-            name=event_name,
+def check_data_loss(gaze: pm.GazeDataFrame, report: ReportFunction) -> None:
+    screens = gap_metrics(gaze)
+    trials = rollup_gaps(screens, ["trial", "stimulus"]).sort("trial")
+    report(
+        "Data loss ratio per trial",
+        trials.get_column("data_loss_ratio").to_list(),
+        config.ACCEPTABLE_DATA_LOSS_RATIOS,
+        percentage=True,
+    )
+    report("Blinks per trial", trials.get_column("num_blinks").to_list(), (0, config.infinity))
+    lower, upper = config.ACCEPTABLE_DATA_LOSS_RATIOS
+    report(
+        "Screens with too much data loss",
+        [
+            f"{trial} {screen}: {ratio:.2%}, {num_gaps} gaps, longest {longest_gap:.0f} ms"
+            for trial, screen, ratio, num_gaps, longest_gap in screens.filter(
+                ~pl.col("data_loss_ratio").is_between(lower, upper)
+            )
+            .select("trial", "screen", "data_loss_ratio", "num_gaps", "longest_gap_ms")
+            .iter_rows()
+        ],
+        [],
+    )
+
+
+def check_artifacts(gaze: pm.GazeDataFrame, report: ReportFunction) -> None:
+    screens = session_metrics(gaze)["screen"]
+    lower, upper = config.ACCEPTABLE_ARTIFACT_RATIOS
+    report(
+        "Screens with optical artifacts",
+        [
+            f"{trial} {screen}: {ratio:.2%} in {num_artifacts} artifacts"
+            for trial, screen, ratio, num_artifacts in screens.filter(
+                ~pl.col("artifact_ratio").is_between(lower, upper)
+            )
+            .select("trial", "screen", "artifact_ratio", "num_artifacts")
+            .iter_rows()
+        ],
+        [],
+    )
+
+
+def check_recordings(
+    messages: pl.DataFrame, report: ReportFunction, logfile: pl.DataFrame | None = None
+) -> None:
+    """Screen completeness from the recording messages alone, without the samples"""
+    recordings = (
+        messages.filter(pl.col("event").is_not_null())
+        .group_by("trial", "screen", maintain_order=True)
+        .agg(
+            (pl.col("event") == "start_recording").sum().alias("starts"),
+            (pl.col("event") == "stop_recording").sum().alias("stops"),
+        )
+    )
+    trials = recordings.filter(pl.col("stops") > 0).get_column("trial").unique(maintain_order=True)
+    report(
+        "Number of practice trials",
+        trials.str.starts_with("PRACTICE_").sum(),
+        config.ACCEPTABLE_NUM_PRACTICE_TRIALS,
+    )
+    report(
+        "Number of trials",
+        trials.str.starts_with("trial_").sum(),
+        config.ACCEPTABLE_NUM_TRIALS,
+    )
+    incomplete = recordings.filter(pl.col("starts") != pl.col("stops"))
+    report(
+        "Screens with unmatched start/stop_recording",
+        [f"{trial} {screen}" for trial, screen in incomplete.select("trial", "screen").iter_rows()],
+        [],
+    )
+    if logfile is not None and "trial_number" in logfile.columns:
+        # The logfile numbers the trials without the prefix of the recording messages
+        recorded = trials.str.extract(r"(\d+)$").cast(pl.Int64)
+        logged = (
+            normalize_logfile(logfile.lazy())
+            .collect()
+            .get_column("trial_number")
+            .drop_nulls()
+            .unique(maintain_order=True)
+        )
+        report(
+            "Trials in logfile without recording",
+            logged.filter(~logged.is_in(recorded)).to_list(),
+            [],
         )
-        join_on = gaze.trial_columns + ["name", "onset", "offset"]
-        gaze.events.add_event_properties(new_properties, join_on=join_on)
-    # TODO: AOI mapping
 
 
-def check_events(events: pm.EventDataFrame, report: ReportFunction) -> None:
-    pass  # TODO: Fixations on/off stimulus etc.
+def check_screens(
+    messages: pl.DataFrame,
+    manifest: pl.DataFrame,
+    report: ReportFunction,
+    logfile: pl.DataFrame | None = None,
+) -> None:
+    """Recorded screens against the screens of the stimuli, see `stimulus.screen_manifest`"""
+    observed = {"recording": observed_screens_asc(messages)}
+    if logfile is not None:
+        observed["logfile"] = observed_screens_logfile(logfile, manifest)
+    for source, screens in observed.items():
+        missing, unexpected = screen_completeness(manifest, screens)
+        report(
+            f"Screens missing in {source}",
+            [f"{stimulus} {screen}" for stimulus, screen in missing.iter_rows()],
+            [],
+        )
+        report(
+            f"Unexpected screens in {source}",
+            [f"{trial} {stimulus} {screen}" for trial, stimulus, screen in unexpected.iter_rows()],
+            [],
+        )
+
+
+def check_flow(messages: pl.DataFrame, report: ReportFunction) -> None:
+    deviations = FlowAutomaton.compile(EXPERIMENT_FLOW).check(messages)
+    report(
+        "Deviations from the experiment flow",
+        [
+            f"{timestamp:.0f} {deviation} ({message}): {detail}"
+            for timestamp, message, deviation, detail in deviations.iter_rows()
+        ],
+        [],
+    )
+
+
+def check_validations(timeline: Timeline, report: ReportFunction) -> None:
+    trial_validations = timeline.trial_validations().filter(pl.col("stimulus").is_not_null())
+    report(
+        "AVG validation scores before each text",
+        trial_validations.get_column("validation_score_avg").fill_null(float("nan")).to_list(),
+        config.ACCEPTABLE_AVG_VALIDATION_SCORES,
+    )
+    report(
+        "Texts without validation before",
+        trial_validations.filter(pl.col("validation_timestamp").is_null())
+        .get_column("stimulus")
+        .to_list(),
+        [],
+    )
+    report(
+        "Bad validations without recalibration",
+        timeline.bad_validations()
+        .filter(~pl.col("recalibrated"))
+        .select(pl.format("{} at {}", "validation_score_avg", "timestamp"))
+        .to_series()
+        .to_list(),
+        [],
+    )
+
+
+def write_live_report(
+    scanner: AscScanner, logfile: pl.DataFrame | None, report_to: Path
+) -> None:
+    """Rewrite the report with the checks that only need the lines scanned so far"""
+    with open(report_to, "w", encoding="utf-8") as report_file:
+        report = partial(report_to_file, report_file=report_file)
+        check_metadata(scanner.get_metadata(), report)
+        messages = scanner.get_messages()
+        check_recordings(messages, report, logfile)
+        check_validations(Timeline.build(messages, scanner.get_metadata()), report)
+    logging.info(f"Updated {report_to}")
+
+
+def check_events(
+    gaze: pm.GazeDataFrame, report: ReportFunction, stimuli: list[Stimulus] | None = None
+) -> None:
+    """Fixations on and off the text, pages are only checked if their `stimuli` are given"""
+    screens = fixation_locations(gaze, stimuli if stimuli is not None else [])
+    pages = screens.filter(pl.col("on_text_ratio").is_not_null())
+    if not pages.is_empty():
+        report(
+            "Ratio of fixations on the text",
+            (pages.get_column("on_text_ratio") * pages.get_column("num_fixations")).sum()
+            / pages.get_column("num_fixations").sum(),
+            config.ACCEPTABLE_ON_TEXT_FIXATION_RATIOS,
+            percentage=True,
+        )
+        lower, upper = config.ACCEPTABLE_ON_TEXT_FIXATION_RATIOS
+        report(
+            "Pages with few fixations on the text",
+            [
+                f"{trial} {screen}: {ratio:.2%} of {num_fixations} fixations"
+                for trial, screen, ratio, num_fixations in pages.filter(
+                    ~pl.col("on_text_ratio").is_between(lower, upper)
+                )
+                .select("trial", "screen", "on_text_ratio", "num_fixations")
+                .iter_rows()
+            ],
+            [],
+        )
+    lower, upper = config.ACCEPTABLE_OFF_SCREEN_FIXATION_RATIOS
+    report(
+        "Screens with fixations off the screen",
+        [
+            f"{trial} {screen}: {ratio:.2%} of {num_fixations} fixations"
+            for trial, screen, ratio, num_fixations in screens.filter(
+                ~pl.col("off_screen_ratio").is_between(lower, upper)
+            )
+            .select("trial", "screen", "off_screen_ratio", "num_fixations")
+            .iter_rows()
+        ],
+        [],
+    )
 
 
 def plot_gaze(gaze: pm.GazeDataFrame, stimulus_dir: Path, plots_dir: Path, ) -> None:
@@ -342,24 +497,72 @@ def main() -> None:
         help="Path to save the report",
     )
     parser.add_argument("--plots-dir", type=Path, help="Path to save the plots")
+    parser.add_argument("--lang", default="zh", help="Language of the session, for the stimuli")
+    parser.add_argument("--country", default="ch", help="Country of the lab, for the stimuli")
+    parser.add_argument("--labnum", type=int, default=1, help="Number of the lab, for the stimuli")
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Follow the ASC file while it is written and update the report after every screen",
+    )
+    parser.add_argument(
+        "--logfile", type=Path, help="Path to the EXPERIMENT_LOGFILE, followed along with --follow"
+    )
+    parser.add_argument(
+        "--poll-interval", type=float, default=5.0, help="Seconds between checks for new data"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600.0,
+        help="Stop following when no new data was written for this many seconds",
+    )
     args = parser.parse_args()
     if args.report_to is None:
         args.report_to = Path(args.asc_file.stem + "_report.txt")
     if args.plots_dir is None:
         args.plots_dir = Path(args.asc_file.stem + "_plots")
 
+    logging.basicConfig(level=logging.INFO)
+
+    if args.follow:
+        logging.info(f"Following {args.asc_file}...")
+        scanner = follow_asc(
+            args.asc_file,
+            partial(write_live_report, report_to=args.report_to),
+            logfile=args.logfile,
+            poll_interval=args.poll_interval,
+            idle_timeout=args.idle_timeout,
+        )
+        # The whole file was already scanned. The live report is replaced below, it only
+        # has some of the checks and misses everything after the last recording.
+        session = scanner.session()
+    else:
+        # One pass over the file, the messages and metadata cover the whole file, only the
+        # samples are of the trials
+        session = scan_asc(args.asc_file, trials_only=True)
+
     report_file = open(args.report_to, "w", encoding="utf-8")
     args.plots_dir.mkdir(exist_ok=True)
     report = partial(report_to_file, report_file=report_file)
 
-    logging.basicConfig(level=logging.INFO)
+    logging.info("Checking metadata...")
+    check_metadata(session.metadata, report)
+    logging.info("Checking recordings and validations...")
+    logfile = None
+    if args.logfile is not None:
+        logfile = pl.read_csv(args.logfile, separator="\t", infer_schema=False, quote_char=None)
+    check_recordings(session.messages, report, logfile)
+    check_validations(Timeline.build(session.messages, session.metadata), report)
+    check_flow(session.messages, report)
 
     logging.info("Loading data...")
-    gaze = load_data(args.asc_file, args.stimulus_dir, config=None)
+    gaze = load_data(args.asc_file, args.stimulus_dir, config=None, session=session)
     logging.info("Checking gaze data...")
     check_gaze(gaze, report)
+    check_data_loss(gaze, report)
     logging.info("Preprocessing...")
-    preprocess(gaze)
+    preprocess(gaze, config.SG_WINDOW_LENGTH, config.SG_DEGREE, config.PREPROCESS_PARTITION_BY)
 
     # import pickle
 
@@ -371,7 +574,9 @@ def main() -> None:
     #     gaze = pickle.load(f)
 
     logging.info("Checking event data...")
-    check_events(gaze.events, report)
+    stimuli, _ = load_stimuli(args.stimulus_dir, args.lang, args.country, args.labnum)
+    check_events(gaze, report, stimuli)
+    check_artifacts(gaze, report)
     logging.info("Generating gaze plots...")
     plot_gaze(gaze, args.stimulus_dir, args.plots_dir)
     logging.info("Generating main sequence plot...")
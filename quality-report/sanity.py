@@ -4,9 +4,11 @@ import pandas as pd
 import re
 from dataclasses import dataclass
 import os
-from plot import load_data, preprocess
-from stimulus import load_stimuli
-import pickle
+import config
+from asc import AscSession, scan_asc
+from cache import load_preprocessed
+from logfile import read_completed_stimuli, scan_logfiles
+from stimulus import LabConfig
 @dataclass
 class Sanity:
     """Class for perfomring Sanity checks"""
@@ -25,10 +27,11 @@ class Sanity:
     experiment_config: Path
     report_file: Path
     plot_dir: Path
-    logfile: pd.DataFrame
-    completed_stimuli: pd.DataFrame
+    logfile: pl.DataFrame
+    completed_stimuli: pl.DataFrame
     stimuli_order: list
     gaze: pd.DataFrame = None
+    session: AscSession = None
     def __post_init__(self):
         self.output_dir.mkdir(exist_ok=True)
         self.plot_dir.mkdir(exist_ok=True)
@@ -70,6 +73,7 @@ class Sanity:
         else:
             raise ValueError("No match found")
 
+        completed_stimuli = read_completed_stimuli(Path(logfile_path).parent)
         return cls(
             lang=vars_dict["lang"],
             city=vars_dict["data_coll_abr"].split("_")[2],
@@ -92,10 +96,9 @@ class Sanity:
             plot_dir=Path(f"{output_dir}\{vars_dict['participant_abbr']}_plots"),
             # plot_dir=Path(
             #    f"{local_file_path}\quality-report\output\{vars_dict['data_coll_abr']}\{vars_dict['participant_abbr']}_plots"),
-            logfile=pl.read_csv(logfile_path, separator="\t"),
-            completed_stimuli=pl.read_csv(Path(logfile_path).parent / "completed_stimuli.csv", separator=","),
-            stimuli_order=pl.read_csv(Path(logfile_path).parent / "completed_stimuli.csv", separator=",")[
-                "stimulus_id"].to_list()
+            logfile=scan_logfiles({vars_dict["participant_abbr"]: Path(logfile_path)}).collect(),
+            completed_stimuli=completed_stimuli,
+            stimuli_order=completed_stimuli["stimulus_id"].to_list(),
         )
 
     @staticmethod
@@ -105,22 +108,30 @@ class Sanity:
             report_file.write(f"{message}\n")
 
 
+    def get_session(self) -> AscSession:
+        ### Scan the ASC file once and share samples, messages and metadata between all checks
+        if self.session is None:
+            self.session = scan_asc(self.asc_file)
+        return self.session
+
     def get_frame(self):
 
         ### Create or load gaze dataframe from ASC file, with the provided lab configuration
-        ### Only execute if no gaze dataframe is available
-        try:
-            with open(self.output_dir / Path(f"{self.participant_abbr}_gaze.pkl"), "rb") as f:
-                gaze = pickle.load(f)
-        except FileNotFoundError:
-            stimuli, lab_config = load_stimuli(self.stimulus_file_path, self.lang, self.country, self.labnum)
-            gaze = load_data(self.asc_file, lab_config)
-            preprocess(gaze)
-            ### save and load the gaze dataframe to pickle for later usage
-            with open(self.output_dir / f"{self.participant_abbr}_gaze.pkl", "wb") as f:
-                pickle.dump(gaze, f)
-            with open(self.output_dir / f"{self.participant_abbr}_gaze.pkl", "rb") as f:
-                gaze = pickle.load(f)
+        ### The cache is keyed by the ASC contents, the lab configuration and the preprocessing
+        ### parameters, so it is rebuilt whenever one of them changes
+        lab_config = LabConfig.load(self.stimulus_file_path, self.lang, self.country, self.labnum)
+        preprocess_kwargs = {
+            "sg_window_length": config.SG_WINDOW_LENGTH,
+            "sg_degree": config.SG_DEGREE,
+            "partition_by": config.PREPROCESS_PARTITION_BY,
+        }
+        gaze = load_preprocessed(
+            self.asc_file,
+            lab_config,
+            self.output_dir / "cache",
+            scan=lambda asc_file: self.get_session(),
+            **preprocess_kwargs,
+        )
 
         self.gaze = gaze
         return gaze
@@ -1,7 +1,8 @@
 import ast
 import importlib
 import json
-from dataclasses import dataclass
+import shutil
+from dataclasses import asdict, dataclass
 from glob import glob
 from pathlib import Path
 from typing import Literal
@@ -57,6 +58,30 @@ class ComprehensionQuestion:
 
 
 
+@dataclass
+class StimulusTables:
+    stimuli: pl.DataFrame
+    questions: pl.DataFrame
+    instructions: pl.DataFrame
+
+    @staticmethod
+    def paths(stimulus_dir: Path, lang: str) -> list[Path]:
+        return [
+            stimulus_dir / f"multipleye_stimuli_experiment_{lang}.xlsx",
+            stimulus_dir / f"multipleye_comprehension_questions_{lang}.xlsx",
+            stimulus_dir / f"multipleye_participant_instructions_{lang}_with_img_paths.csv",
+        ]
+
+    @classmethod
+    def read(cls, stimulus_dir: Path, lang: str) -> "StimulusTables":
+        stimuli_path, questions_path, instructions_path = cls.paths(stimulus_dir, lang)
+        return cls(
+            stimuli=pl.read_excel(stimuli_path),
+            questions=pl.read_excel(questions_path),
+            instructions=pl.read_csv(instructions_path),
+        )
+
+
 @dataclass
 class Stimulus:
     id: int
@@ -76,10 +101,13 @@ class Stimulus:
         country: str,
         labnum: int,
         stimulus_name: str,
+        tables: StimulusTables | None = None,
     ) -> "Stimulus":
         assert stimulus_name in NAMES, f"{stimulus_name!r} is not a valid stimulus name"
-        stimulus_df_path = stimulus_dir / f"multipleye_stimuli_experiment_{lang}.xlsx"
-        stimulus_df = pl.read_excel(stimulus_df_path)
+        # The tables are shared by all stimuli, `load_stimuli` reads them only once
+        if tables is None:
+            tables = StimulusTables.read(stimulus_dir, lang)
+        stimulus_df = tables.stimuli
         stimulus_row = stimulus_df.row(
             by_predicate=pl.col("stimulus_name") == stimulus_name, named=True
         )
@@ -126,10 +154,7 @@ class Stimulus:
             page_column="page",
         )
 
-        questions_df_path = (
-            stimulus_dir / f"multipleye_comprehension_questions_{lang}.xlsx"
-        )
-        questions_df = pl.read_excel(questions_df_path)
+        questions_df = tables.questions
         question_rows = questions_df.filter(
             pl.col("stimulus_name") == stimulus_name
         ).rows(named=True)
@@ -161,11 +186,7 @@ class Stimulus:
             questions.append(question)
 
         # TODO: Instructions are the same for all stimuli, so this is not the best place to put them
-        instruction_df_path = (
-            stimulus_dir
-            / f"multipleye_participant_instructions_{lang}_with_img_paths.csv"
-        )
-        instruction_df = pl.read_csv(instruction_df_path)
+        instruction_df = tables.instructions
         #rating_df = instruction_df.filter(pl.col("instruction_screen_id").is_in([15.0, 16.0, 17.0]))
         instructions = []
         ratings = []
@@ -255,15 +276,168 @@ class LabConfig:
 
 
 def load_stimuli(
-    stimulus_dir: Path, lang: str, country: str, labnum: int
+    stimulus_dir: Path,
+    lang: str,
+    country: str,
+    labnum: int,
+    catalog_dir: Path | None = None,
 ) -> tuple[list[Stimulus], LabConfig]:
+    """Load all stimuli of a lab
+
+    With a `catalog_dir`, the parsed stimuli are stored there and reused as long as
+    the stimulus files do not change, see `load_catalog`.
+    """
+    if catalog_dir is None:
+        stimuli = _read_stimuli(stimulus_dir, lang, country, labnum)
+    else:
+        stimuli = load_catalog(stimulus_dir, lang, country, labnum, catalog_dir)
+    config = LabConfig.load(stimulus_dir, lang, country, labnum)
+
+    return stimuli, config
+
+
+def screen_manifest(stimuli: list[Stimulus]) -> pl.DataFrame:
+    """Expected screens of every stimulus, with the `page_number` each has in the logfile
+
+    Questions are logged with their id with or without the first leading zero, so they
+    have two rows.
+    """
+    rows = []
+    for stimulus in stimuli:
+        key = f"{stimulus.name}_{stimulus.id}"
+        for page in stimulus.pages:
+            rows.append((key, stimulus.id, f"page_{page.number}", str(page.number)))
+        for question in stimulus.questions:
+            # Screen names don't have leading zeros
+            screen = f"question_{int(question.id)}"
+            rows.append((key, stimulus.id, screen, question.id))
+            rows.append((key, stimulus.id, screen, question.id[1:]))
+        for rating in stimulus.ratings:
+            rows.append((key, stimulus.id, rating.name, rating.name))
+    return pl.DataFrame(
+        rows,
+        schema={"stimulus": pl.Utf8, "stimulus_id": pl.Int64, "screen": pl.Utf8, "logfile_page": pl.Utf8},
+        orient="row",
+    ).unique(maintain_order=True)
+
+
+def _read_stimuli(stimulus_dir: Path, lang: str, country: str, labnum: int) -> list[Stimulus]:
+    tables = StimulusTables.read(stimulus_dir, lang)
     stimuli = []
     for stimulus_name in NAMES:
-        stimulus = Stimulus.load(stimulus_dir, lang, country, labnum, stimulus_name)
+        stimulus = Stimulus.load(stimulus_dir, lang, country, labnum, stimulus_name, tables)
         stimuli.append(stimulus)
-    config = LabConfig.load(stimulus_dir, lang, country, labnum)
+    return stimuli
 
-    return stimuli, config
+
+# Bump this whenever `Stimulus.load` or the catalog format change
+CATALOG_VERSION = 1
+TEXT_STIMULUS_ATTRIBUTES = [
+    "aoi_column",
+    "start_x_column",
+    "start_y_column",
+    "width_column",
+    "height_column",
+    "end_x_column",
+    "end_y_column",
+    "page_column",
+]
+
+
+def load_catalog(
+    stimulus_dir: Path, lang: str, country: str, labnum: int, catalog_dir: Path
+) -> list[Stimulus]:
+    """Load the stimuli of a lab from its catalog, and (re)build it if the stimulus files changed"""
+    lab_dir = catalog_dir / f"{lang}_{country}_{labnum}"
+    fingerprint = catalog_fingerprint(stimulus_dir, lang, country, labnum)
+    if (lab_dir / "catalog.json").exists():
+        with open(lab_dir / "catalog.json", encoding="utf-8") as f:
+            catalog = json.load(f)
+        if catalog["version"] == CATALOG_VERSION and catalog["fingerprint"] == fingerprint:
+            return [_stimulus_from_catalog(stimulus, lab_dir) for stimulus in catalog["stimuli"]]
+
+    stimuli = _read_stimuli(stimulus_dir, lang, country, labnum)
+    _save_catalog(stimuli, fingerprint, lab_dir)
+    return stimuli
+
+
+def catalog_fingerprint(
+    stimulus_dir: Path, lang: str, country: str, labnum: int
+) -> list[list]:
+    """Sizes and modification times of all files the stimuli of a lab are read from
+
+    This includes every image, so it also changes when an image is replaced in place.
+    """
+    image_dirs = [
+        stimulus_dir / f"stimuli_images_{lang}_{country}_{labnum}",
+        stimulus_dir / f"question_images_{lang}_{country}_{labnum}" / "question_images_version_1",
+        stimulus_dir / f"participant_instructions_images_{lang}_{country}_1",
+    ]
+    paths = StimulusTables.paths(stimulus_dir, lang)
+    paths += sorted((stimulus_dir / f"aoi_stimuli_{lang}_{country}_{labnum}").glob("*"))
+    # The folders themselves are listed so that a missing folder is part of the fingerprint
+    paths += [path for image_dir in image_dirs for path in [image_dir, *sorted(image_dir.glob("*"))]]
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            fingerprint.append([str(path), None, None])
+        else:
+            fingerprint.append([str(path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def _save_catalog(stimuli: list[Stimulus], fingerprint: list[list], lab_dir: Path) -> None:
+    # Write into a temporary directory first so that a crash never leaves a half written catalog
+    tmp_dir = lab_dir.with_name(lab_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    (tmp_dir / "aoi").mkdir(parents=True)
+
+    catalog_stimuli = []
+    for stimulus in stimuli:
+        text_stimulus = stimulus.text_stimulus
+        text_stimulus.aois.write_ipc(tmp_dir / "aoi" / f"{stimulus.name}.arrow")
+        catalog_stimuli.append(
+            {
+                "id": stimulus.id,
+                "name": stimulus.name,
+                "type": stimulus.type,
+                "pages": [asdict(page) for page in stimulus.pages],
+                "text_stimulus": {
+                    attribute: getattr(text_stimulus, attribute)
+                    for attribute in TEXT_STIMULUS_ATTRIBUTES
+                },
+                "questions": [asdict(question) for question in stimulus.questions],
+                "instructions": [asdict(instruction) for instruction in stimulus.instructions],
+                "ratings": [asdict(rating) for rating in stimulus.ratings],
+            }
+        )
+    catalog = {"version": CATALOG_VERSION, "fingerprint": fingerprint, "stimuli": catalog_stimuli}
+    with open(tmp_dir / "catalog.json", "w", encoding="utf-8") as f:
+        json.dump(catalog, f, indent=2, default=str)  # Paths are stored as strings
+
+    shutil.rmtree(lab_dir, ignore_errors=True)
+    tmp_dir.rename(lab_dir)
+
+
+def _stimulus_from_catalog(stimulus: dict, lab_dir: Path) -> Stimulus:
+    def with_path(item: dict) -> dict:
+        return {**item, "image_path": Path(item["image_path"])}
+
+    return Stimulus(
+        id=stimulus["id"],
+        name=stimulus["name"],
+        type=stimulus["type"],
+        pages=[StimulusPage(**with_path(page)) for page in stimulus["pages"]],
+        text_stimulus=pm.stimulus.TextStimulus(
+            pl.read_ipc(lab_dir / "aoi" / f"{stimulus['name']}.arrow"),
+            **stimulus["text_stimulus"],
+        ),
+        questions=[ComprehensionQuestion(**with_path(question)) for question in stimulus["questions"]],
+        instructions=[Instruction(**with_path(instruction)) for instruction in stimulus["instructions"]],
+        ratings=[Rating(**with_path(rating)) for rating in stimulus["ratings"]],
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,374 @@
+import argparse
+import datetime
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TextIO
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import polars as pl
+import pymovements as pm
+
+from stimulus import NAMES, ComprehensionQuestion, Rating, Stimulus, StimulusPage
+
+EYES = {"L": ["LEFT"], "R": ["RIGHT"], "LR": ["LEFT", "RIGHT"]}
+RATINGS = ["familiarity_rating_screen_1", "subject_difficulty_screen"]
+# Share of the recording time of each kind of screen
+SCREEN_WEIGHTS = {"page": 1.0, "question": 0.3, "rating": 0.1}
+
+
+@dataclass
+class SessionSpec:
+    """Parameters of a synthetic session
+
+    The text of every page is a block of lines of equally wide characters, read line by
+    line with fixations of gamma distributed durations. `noise_px` is the standard
+    deviation of the gaze position during fixations.
+    """
+
+    sampling_rate: int = 1000
+    duration_min: float = 60.0
+    eye: str = "L"
+    noise_px: float = 0.5
+    num_practice_trials: int = 2
+    num_trials: int = 10
+    num_pages: int = 6
+    num_questions: int = 6
+    screen_width_px: int = 1280
+    screen_height_px: int = 1024
+    num_lines: int = 12
+    chars_per_line: int = 50
+    char_width_px: int = 20
+    line_height_px: int = 60
+    blinks_per_s: float = 0.2
+    data_loss_ratio: float = 0.005  # Samples without a gaze position outside of blinks
+    seed: int = 0
+
+    def __post_init__(self) -> None:
+        assert self.eye in EYES, f"Unknown eye {self.eye}, expected one of {list(EYES)}"
+        assert self.num_practice_trials + self.num_trials <= len(NAMES), f"Only {len(NAMES)} stimuli"
+
+    @property
+    def text_left(self) -> int:
+        return (self.screen_width_px - self.chars_per_line * self.char_width_px) // 2
+
+    @property
+    def text_top(self) -> int:
+        return (self.screen_height_px - self.num_lines * self.line_height_px) // 2
+
+    def trials(self) -> list[tuple[str, str, int]]:
+        """Trial name, stimulus name and stimulus id of every trial, in the order shown"""
+        # The last stimuli are the practice texts
+        practice = [
+            (f"PRACTICE_trial_{i + 1}", NAMES[-1 - i], len(NAMES) - i)
+            for i in range(self.num_practice_trials)
+        ]
+        return practice + [(f"trial_{i + 1}", NAMES[i], i + 1) for i in range(self.num_trials)]
+
+    def screens(self, name: str, stimulus_id: int) -> list[tuple[str, str]]:
+        """Kind and name of the recorded screens of a trial"""
+        return (
+            [("page", f"stimulus_{name}_{stimulus_id}_page_{page}") for page in range(1, self.num_pages + 1)]
+            + [("question", f"stimulus_{name}_{stimulus_id}_question_{id}") for id in self._questions()]
+            + [("rating", rating) for rating in RATINGS]
+        )
+
+    def _questions(self) -> list[int]:
+        return [11 + i for i in range(self.num_questions)]
+
+
+def write_asc(path: Path, spec: SessionSpec) -> None:
+    """Write a synthetic EyeLink ASC file with the messages of the MultiplEYE experiment"""
+    with open(path, "w", encoding="utf-8") as f:
+        _AscWriter(f, spec).write()
+
+
+def synthetic_stimuli(spec: SessionSpec, image_dir: Path) -> list[Stimulus]:
+    """Stimuli matching the sessions of `write_asc`, with blank images and character AOIs"""
+    image_dir.mkdir(parents=True, exist_ok=True)
+    size = (spec.screen_width_px, spec.screen_height_px)
+    blank_path = image_dir / "blank.png"
+    PIL.Image.new("RGB", size, "white").save(blank_path)
+    page_path = image_dir / "page.png"
+    image = PIL.Image.new("RGB", size, "white")
+    draw = PIL.ImageDraw.Draw(image)
+    for line in range(spec.num_lines):
+        top = spec.text_top + line * spec.line_height_px
+        draw.rectangle(
+            (spec.text_left, top + 10, spec.text_left + spec.chars_per_line * spec.char_width_px, top + 40),
+            fill="lightgray",
+        )
+    image.save(page_path)
+
+    line, column = np.divmod(np.arange(spec.num_lines * spec.chars_per_line), spec.chars_per_line)
+    page_aois = pl.DataFrame(
+        {
+            "char": "x",
+            "top_left_x": spec.text_left + column * spec.char_width_px,
+            "top_left_y": spec.text_top + line * spec.line_height_px,
+            "width": spec.char_width_px,
+            "height": spec.line_height_px,
+            "char_idx": np.arange(len(line)),
+            "word_idx": (line * spec.chars_per_line + column) // 6,
+        }
+    )
+    aois = pl.concat(
+        page_aois.with_columns(pl.lit(f"page_{page}").alias("page")) for page in range(1, spec.num_pages + 1)
+    )
+    stimuli = []
+    for trial, name, stimulus_id in spec.trials():
+        stimuli.append(
+            Stimulus(
+                id=stimulus_id,
+                name=name,
+                type="practice" if trial.startswith("PRACTICE_") else "experiment",
+                pages=[StimulusPage(number, "", page_path) for number in range(1, spec.num_pages + 1)],
+                text_stimulus=pm.stimulus.TextStimulus(
+                    aois,
+                    aoi_column="char",
+                    start_x_column="top_left_x",
+                    start_y_column="top_left_y",
+                    width_column="width",
+                    height_column="height",
+                    page_column="page",
+                ),
+                questions=[
+                    ComprehensionQuestion(f"question_{id}", f"0{id}", "", "", "", "", "", blank_path)
+                    for id in spec._questions()
+                ],
+                instructions=[],
+                ratings=[Rating(i, rating, "", blank_path) for i, rating in enumerate(RATINGS)],
+            )
+        )
+    return stimuli
+
+
+class _AscWriter:
+    def __init__(self, f: TextIO, spec: SessionSpec) -> None:
+        self.f = f
+        self.spec = spec
+        self.rng = np.random.default_rng(spec.seed)
+        self.eyes = EYES[spec.eye]
+        self.timestamp = 1_000_000
+        weights = [
+            SCREEN_WEIGHTS[kind]
+            for _, name, stimulus_id in spec.trials()
+            for kind, _ in spec.screens(name, stimulus_id)
+        ]
+        self.ms_per_weight = spec.duration_min * 60_000 / sum(weights)
+
+    def message(self, text: str, delay_ms: int = 0) -> None:
+        self.timestamp += delay_ms
+        self.f.write(f"MSG\t{self.timestamp} {text}\n")
+
+    def write(self) -> None:
+        spec = self.spec
+        date = datetime.datetime(2024, 3, 8, 9, 25, 20) + datetime.timedelta(days=spec.seed)
+        self.f.write(
+            "** CONVERTED FROM synthetic.edf using edfapi 4.2.1 Mar  8 2022\n"
+            f"** DATE: {date:%a %b} {date.day:2d} {date:%H:%M:%S %Y}\n"
+            "** TYPE: EDF_FILE BINARY EVENT SAMPLE TAGGED\n"
+            "** VERSION: EYELINK II 1\n"
+            "** SOURCE: EYELINK CL\n"
+            "** EYELINK 1000 Plus, v5.12 Jun 21 2016 (EyeLink Portable Duo)\n"
+            "**\n\n"
+        )
+        self.message(f"DISPLAY_COORDS 0 0 {spec.screen_width_px - 1} {spec.screen_height_px - 1}")
+        self.message("ELCLCFG BTABLER")
+        for screen in [
+            "welcome_screen",
+            "informed_consent_screen",
+            "start_experiment",
+            "stimulus_order_version: 1",
+            "showing_instruction_screen_1",
+            "showing_instruction_screen_2",
+            "showing_instruction_screen_3",
+            "camera_setup_screen",
+        ]:
+            self.message(screen, delay_ms=2000)
+        self.calibrate()
+        self.message("practice_text_starting_screen", delay_ms=1000)
+
+        trials = spec.trials()
+        break_after = spec.num_practice_trials + (spec.num_trials + 1) // 2
+        for i, (trial, name, stimulus_id) in enumerate(trials):
+            if i == spec.num_practice_trials:
+                self.message("transition_screen", delay_ms=2000)
+            if i == break_after:
+                self.message("obligatory_break", delay_ms=1000)
+                self.message("obligatory_break_end", delay_ms=300_000)
+                self.message("obligatory_break_duration: 300000", delay_ms=1)
+            if i > spec.num_practice_trials:
+                self.validate("validation_before_stimulus")
+            for kind, screen in spec.screens(name, stimulus_id):
+                if kind == "rating":
+                    self.message(f"showing_{screen}", delay_ms=200)
+                self.record(trial, kind, screen)
+        self.validate("final_validation")
+        self.message("show_final_screen", delay_ms=1000)
+
+    def calibrate(self) -> None:
+        self.message("!CAL ", delay_ms=5000)
+        self.f.write(f">>>>>>> CALIBRATION (HV9,P-CR) FOR {self.eyes[0]}: <<<<<<<<<\n")
+        self.validate(None)
+
+    def validate(self, message: str | None) -> None:
+        if message is not None:
+            self.message(message, delay_ms=1000)
+        for eye in self.eyes:
+            avg_error = self.rng.gamma(4, 0.04)
+            max_error = avg_error + self.rng.gamma(4, 0.08)
+            offset_x, offset_y = self.rng.normal(0, 3, 2)
+            self.message(
+                f"!CAL VALIDATION HV9 {eye[0]} {eye}  GOOD ERROR {avg_error:.2f} avg. {max_error:.2f} max  "
+                f"OFFSET {avg_error * 0.5:.2f} deg. {offset_x:.1f},{offset_y:.1f} pix.",
+                delay_ms=3000,
+            )
+
+    def record(self, trial: str, kind: str, screen: str) -> None:
+        spec = self.spec
+        self.timestamp += int(self.rng.integers(300, 1500))
+        start = self.timestamp
+        eyes = "\t".join(self.eyes)
+        self.f.write(
+            f"START\t{start} \t{eyes}\tSAMPLES\tEVENTS\n"
+            "PRESCALER\t1\nVPRESCALER\t1\nPUPIL\tAREA\n"
+            f"EVENTS\tGAZE\t{eyes}\tRATE\t{spec.sampling_rate:.2f}\tTRACKING\tCR\tFILTER\t2\tINPUT\n"
+            f"SAMPLES\tGAZE\t{eyes}\tRATE\t{spec.sampling_rate:.2f}\tTRACKING\tCR\tFILTER\t2\tINPUT\n"
+        )
+        self.message(f"RECCFG CR {spec.sampling_rate} 2 1 {spec.eye}")
+        self.message("ELCLCFG BTABLER")
+        self.message(f"start_recording_{trial}_{screen}")
+
+        duration_ms = self.ms_per_weight * SCREEN_WEIGHTS[kind] * self.rng.uniform(0.8, 1.2)
+        num_samples = max(int(duration_ms * spec.sampling_rate / 1000), 1)
+        time = start + 1 + np.arange(num_samples) * (1000 / spec.sampling_rate)
+        x, y = self.gaze(kind, num_samples)
+        pupil = 800 + 50 * np.sin(np.arange(num_samples) / (5 * spec.sampling_rate))
+        pupil += self.rng.normal(0, 2, num_samples)
+
+        blinks = self.blinks(num_samples)
+        lost = np.zeros(num_samples, dtype=bool)
+        # Short losses of the pupil or corneal reflection, 5 to 50 ms
+        mean_loss_ms = 27.5
+        num_losses = self.rng.poisson(spec.data_loss_ratio * duration_ms / mean_loss_ms)
+        for loss_start in self.rng.integers(0, num_samples, num_losses):
+            lost[loss_start : loss_start + int(self.rng.uniform(5, 50) * spec.sampling_rate / 1000)] = True
+        for blink_start, blink_end in blinks:
+            lost[blink_start:blink_end] = True
+        lines = self.sample_lines(time, x, y, pupil, lost)
+        position = 0
+        for blink_start, blink_end in blinks:
+            self.f.write("\n".join(lines[position:blink_start]) + "\n" if blink_start > position else "")
+            self.f.write(f"SBLINK {self.eyes[0][0]} {time[blink_start]:.0f}\n")
+            self.f.write("\n".join(lines[blink_start:blink_end]) + "\n")
+            self.f.write(
+                f"EBLINK {self.eyes[0][0]} {time[blink_start]:.0f}\t{time[blink_end - 1]:.0f}\t"
+                f"{time[blink_end - 1] - time[blink_start] + 1:.0f}\n"
+            )
+            position = blink_end
+        if position < num_samples:
+            self.f.write("\n".join(lines[position:]) + "\n")
+
+        self.timestamp = int(time[-1]) + 1
+        self.message(f"stop_recording_{trial}_{screen}")
+        self.f.write(f"END\t{self.timestamp} \tSAMPLES\tEVENTS\tRES\t  38.54\t  31.12\n")
+
+    def gaze(self, kind: str, num_samples: int) -> tuple[np.ndarray, np.ndarray]:
+        """Fixations connected by linear saccades, line by line on pages"""
+        spec = self.spec
+        samples_per_ms = spec.sampling_rate / 1000
+        xs, ys = [], []
+        line, column = 0, 0.0
+        total = 0
+        while total < num_samples:
+            if kind == "page":
+                target_x = spec.text_left + (column + 0.5) * spec.char_width_px
+                target_y = spec.text_top + (line + 0.5) * spec.line_height_px
+                column += self.rng.normal(8, 2)
+                if column >= spec.chars_per_line:
+                    line, column = (line + 1) % spec.num_lines, 0.0
+            else:
+                width, height = spec.screen_width_px, spec.screen_height_px
+                target_x = np.clip(self.rng.normal(width / 2, width / 6), 0, width - 1)
+                target_y = np.clip(self.rng.normal(height / 2, height / 6), 0, height - 1)
+            if xs:
+                amplitude = np.hypot(target_x - xs[-1][-1], target_y - ys[-1][-1])
+                saccade = max(int((20 + amplitude / 20) * samples_per_ms), 2)
+                xs.append(np.linspace(xs[-1][-1], target_x, saccade + 1)[1:])
+                ys.append(np.linspace(ys[-1][-1], target_y, saccade + 1)[1:])
+                total += saccade
+            fixation = max(int(self.rng.gamma(6, 35) * samples_per_ms), 1)
+            xs.append(target_x + self.rng.normal(0, spec.noise_px, fixation))
+            ys.append(target_y + self.rng.normal(0, spec.noise_px, fixation))
+            total += fixation
+        return np.concatenate(xs)[:num_samples], np.concatenate(ys)[:num_samples]
+
+    def blinks(self, num_samples: int) -> list[tuple[int, int]]:
+        spec = self.spec
+        num_blinks = self.rng.poisson(spec.blinks_per_s * num_samples / spec.sampling_rate)
+        blinks = []
+        end = 0
+        for start in np.sort(self.rng.integers(0, num_samples, num_blinks)):
+            start = max(int(start), end + 1)
+            length = int(self.rng.uniform(80, 200) * spec.sampling_rate / 1000)
+            if start + length >= num_samples:
+                break
+            blinks.append((start, start + length))
+            end = start + length
+        return blinks
+
+    def sample_lines(
+        self, time: np.ndarray, x: np.ndarray, y: np.ndarray, pupil: np.ndarray, lost: np.ndarray
+    ) -> list[str]:
+        """Sample lines as written by `edf2asc -input -ftime`"""
+        lost = pl.Series(lost)
+        eye_columns = []
+        for eye in self.eyes:
+            # The second eye looks at almost the same position
+            offset = 0.0 if eye == self.eyes[0] else 2.0
+            for values, width, invalid in [(x + offset, 7, "."), (y + offset, 7, "."), (pupil, 7, "0.0")]:
+                eye_columns.append(
+                    pl.when(lost)
+                    .then(pl.lit(invalid))
+                    .otherwise(pl.Series(values).round(1).cast(pl.Utf8))
+                    .str.pad_start(width)
+                )
+        frame = pl.select(
+            pl.concat_str(
+                pl.lit(pl.Series(time)).cast(pl.Utf8),
+                *eye_columns,
+                pl.when(lost).then(pl.lit("    0.0")).otherwise(pl.lit("  127.0")),
+                pl.lit("..." if len(self.eyes) == 1 else "....."),
+                separator="\t",
+            ).alias("line")
+        )
+        return frame.get_column("line").to_list()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write a synthetic ASC file of a MultiplEYE session")
+    parser.add_argument("asc_file", type=Path, help="Path of the ASC file to write")
+    parser.add_argument("--sampling-rate", type=int, default=1000, help="Samples per second")
+    parser.add_argument("--duration-min", type=float, default=60.0, help="Recording time in minutes")
+    parser.add_argument("--eye", choices=list(EYES), default="L", help="Tracked eye")
+    parser.add_argument("--noise-px", type=float, default=0.5, help="Gaze noise during fixations")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    spec = SessionSpec(
+        sampling_rate=args.sampling_rate,
+        duration_min=args.duration_min,
+        eye=args.eye,
+        noise_px=args.noise_px,
+        seed=args.seed,
+    )
+    write_asc(args.asc_file, spec)
+    logging.info(f"Wrote {args.asc_file} ({args.asc_file.stat().st_size / 1024**2:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from compact import ACTIVITIES, compact_samples, expand_samples
+
+
+def _samples(time: list) -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "time": time,
+            "pixel": [[640.5, 512.25]] * len(time),
+            "trial": "trial_1",
+            "activity": "reading",
+        }
+    )
+
+
+def test_round_trip_2000_hz() -> None:
+    # Timestamps of 2000 Hz recordings have half milliseconds that Float32 cannot hold
+    samples = _samples([14556585.5, 14556586.0, 14556586.5, 14556587.0])
+    compact = compact_samples(samples, {"trial": pl.Categorical(), "activity": pl.Enum(ACTIVITIES)})
+    assert compact.schema["time"] == pl.Float64
+    assert compact.schema["pixel_x"] == pl.Float32
+    assert_frame_equal(expand_samples(compact), samples)
+
+
+def test_round_trip_1000_hz() -> None:
+    samples = _samples([14556585, 14556586, 14556587])
+    compact = compact_samples(samples, {"trial": pl.Categorical(), "activity": pl.Enum(ACTIVITIES)})
+    assert compact.schema["time"] == pl.UInt32
+    assert_frame_equal(expand_samples(compact), samples)
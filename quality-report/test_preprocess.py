@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import polars as pl
+import pymovements as pm
+from polars.testing import assert_frame_equal
+
+from asc import TRIAL_COLUMNS
+from plot import load_data, preprocess
+from stimulus import LabConfig
+from synth import SessionSpec, write_asc
+
+
+def _session_with_repeated_screen(asc_file: Path, spec: SessionSpec) -> pm.GazeDataFrame:
+    resolution = (spec.screen_width_px, spec.screen_height_px)
+    gaze = load_data(asc_file, LabConfig(resolution, (37.0, 28.0), 60.0, resolution, (37.0, 28.0)))
+    # The fourth screen gets the keys of the second, as if it was shown again after the third
+    keys = gaze.frame.select(TRIAL_COLUMNS).unique(maintain_order=True)
+    first, repeated = keys.row(1), keys.row(3)
+    is_repeated = pl.all_horizontal(pl.col(column) == value for column, value in zip(TRIAL_COLUMNS, repeated))
+    gaze.frame = gaze.frame.with_columns(
+        pl.when(is_repeated).then(pl.lit(value)).otherwise(pl.col(column)).alias(column)
+        for column, value in zip(TRIAL_COLUMNS, first)
+    )
+    return gaze
+
+
+def test_partitioned_preprocess_with_non_contiguous_screen(tmp_path: Path) -> None:
+    spec = SessionSpec(duration_min=1, num_practice_trials=1, num_trials=1, num_pages=3, num_questions=1)
+    asc_file = tmp_path / "session.asc"
+    write_asc(asc_file, spec)
+
+    whole = _session_with_repeated_screen(asc_file, spec)
+    samples = whole.frame
+    preprocess(whole)
+    partitioned = _session_with_repeated_screen(asc_file, spec)
+    preprocess(partitioned, partition_by=TRIAL_COLUMNS)
+
+    # The samples keep their order
+    assert_frame_equal(whole.frame.select(samples.columns), samples)
+    assert_frame_equal(partitioned.frame, whole.frame)
+    assert_frame_equal(partitioned.events.frame, whole.events.frame)
@@ -0,0 +1,201 @@
+from dataclasses import dataclass
+from typing import Any
+
+import polars as pl
+
+import config
+
+# Break screens are logged when they start and end, e.g. `optional_break` and `optional_break_end`
+BREAK_KINDS = ["obligatory_break", "optional_break"]
+DRIFT_CHECK_REGEX = r"^DRIFTCORRECT\s+\S+\s+(?P<tracked_eye>LEFT|RIGHT)\b.*?OFFSET\s+(?P<offset>\d+\.?\d*)"
+FIXATION_TRIGGER_REGEX = r"^fixation_trigger(?::(?P<detail>.+))?$"
+
+
+@dataclass
+class Timeline:
+    """Typed tables of the calibration, validation and break events of a session
+
+    All tables are sorted by their timestamp, so that they can be attached to trials and
+    to each other with as-of joins.
+    """
+
+    calibrations: pl.DataFrame
+    validations: pl.DataFrame
+    drift_checks: pl.DataFrame
+    breaks: pl.DataFrame
+    fixation_triggers: pl.DataFrame
+    trials: pl.DataFrame
+
+    @classmethod
+    def build(cls, messages: pl.DataFrame, metadata: dict[str, Any]) -> "Timeline":
+        calibrations = pl.DataFrame(
+            metadata["calibrations"],
+            schema={"timestamp": pl.Utf8, "num_points": pl.Utf8, "type": pl.Utf8, "tracked_eye": pl.Utf8},
+        ).select(
+            pl.col("timestamp").cast(pl.Float64),
+            pl.col("num_points").cast(pl.Int64),
+            "type",
+            "tracked_eye",
+        )
+        validations = pl.DataFrame(
+            metadata["validations"],
+            schema={
+                column: pl.Utf8
+                for column in [
+                    "timestamp",
+                    "num_points",
+                    "tracked_eye",
+                    "error",
+                    "validation_score_avg",
+                    "validation_score_max",
+                ]
+            },
+        ).select(
+            pl.col("timestamp").cast(pl.Float64),
+            pl.col("num_points").cast(pl.Int64),
+            "tracked_eye",
+            pl.col("error").str.strip_chars().str.strip_suffix(" ERROR").alias("error"),
+            pl.col("validation_score_avg").cast(pl.Float64),
+            pl.col("validation_score_max").cast(pl.Float64),
+        )
+
+        messages = messages.select("timestamp", pl.col("message").str.strip_chars().alias("message"))
+        drift_checks = (
+            messages.with_columns(pl.col("message").str.extract_groups(DRIFT_CHECK_REGEX).alias("drift"))
+            .unnest("drift")
+            .filter(pl.col("offset").is_not_null())
+            .select("timestamp", "tracked_eye", pl.col("offset").cast(pl.Float64))
+        )
+        fixation_triggers = (
+            messages.with_columns(
+                pl.col("message").str.extract(FIXATION_TRIGGER_REGEX, 0).alias("trigger"),
+                pl.col("message").str.extract(FIXATION_TRIGGER_REGEX, 1).alias("detail"),
+            )
+            .filter(pl.col("trigger").is_not_null())
+            .select("timestamp", "detail")
+        )
+
+        # Every break start is closed by the next end message of the same kind
+        break_messages = messages.filter(
+            pl.col("message").is_in(BREAK_KINDS + [f"{kind}_end" for kind in BREAK_KINDS])
+        ).with_columns(pl.col("message").str.strip_suffix("_end").alias("kind"))
+        breaks = (
+            break_messages.filter(pl.col("message") == pl.col("kind"))
+            .select("kind", pl.col("timestamp").alias("start"))
+            .join_asof(
+                break_messages.filter(pl.col("message") != pl.col("kind")).select(
+                    "kind", pl.col("timestamp").alias("end")
+                ),
+                left_on="start",
+                right_on="end",
+                by="kind",
+                strategy="forward",
+            )
+            .with_columns((pl.col("end") - pl.col("start")).alias("duration_ms"))
+        )
+
+        trials = (
+            messages.filter(pl.col("message").str.starts_with("start_recording_"))
+            .with_columns(
+                pl.col("message").str.extract(r"^start_recording_((?:PRACTICE_)?trial_\d+)").alias("trial"),
+                pl.col("message")
+                .str.extract(r"_stimulus_([^_]+_[^_]+_\d+)_")
+                .alias("stimulus"),
+            )
+            .filter(pl.col("trial").is_not_null())
+            .group_by("trial", maintain_order=True)
+            .agg(
+                pl.col("stimulus").drop_nulls().first(),
+                pl.col("timestamp").min().alias("start"),
+            )
+        )
+        return cls(
+            calibrations=calibrations.sort("timestamp"),
+            validations=validations.sort("timestamp"),
+            drift_checks=drift_checks.sort("timestamp"),
+            breaks=breaks.sort("start"),
+            fixation_triggers=fixation_triggers.sort("timestamp"),
+            trials=trials.sort("start"),
+        )
+
+    def trial_validations(self) -> pl.DataFrame:
+        """The latest validation before every trial, and whether it was recalibrated
+
+        If a validation was followed by a calibration and another validation, the scores of
+        the last validation are used. `recalibrated` is whether there was a calibration
+        since the previous trial started.
+        """
+        return (
+            self.trials.with_columns(pl.col("start").shift(1).alias("previous_start"))
+            .join_asof(
+                self.validations.select(
+                    pl.col("timestamp").alias("validation_timestamp"),
+                    "error",
+                    "validation_score_avg",
+                    "validation_score_max",
+                ),
+                left_on="start",
+                right_on="validation_timestamp",
+                strategy="backward",
+            )
+            .join_asof(
+                self.calibrations.select(pl.col("timestamp").alias("calibration_timestamp")),
+                left_on="start",
+                right_on="calibration_timestamp",
+                strategy="backward",
+            )
+            .join_asof(
+                self.drift_checks.select(
+                    pl.col("timestamp").alias("drift_check_timestamp"),
+                    pl.col("offset").alias("drift_check_offset"),
+                ),
+                left_on="start",
+                right_on="drift_check_timestamp",
+                strategy="backward",
+            )
+            .with_columns(
+                (pl.col("calibration_timestamp") > pl.col("previous_start").fill_null(-float("inf")))
+                .fill_null(False)
+                .alias("recalibrated"),
+                (pl.col("start") - pl.col("validation_timestamp")).alias("validation_age_ms"),
+            )
+            .drop("previous_start")
+        )
+
+    def bad_validations(
+        self, acceptable_scores: tuple[float, float] = config.ACCEPTABLE_AVG_VALIDATION_SCORES
+    ) -> pl.DataFrame:
+        """Validations with an average score outside `acceptable_scores`, with what followed
+
+        `recalibrated` is whether a calibration followed before the next trial started.
+        """
+        lower, upper = acceptable_scores
+        return (
+            self.validations.with_columns(
+                pl.col("timestamp").shift(-1).alias("next_validation_timestamp"),
+                pl.col("validation_score_avg").shift(-1).alias("next_validation_score_avg"),
+            )
+            .filter(~pl.col("validation_score_avg").is_between(lower, upper))
+            .join_asof(
+                self.calibrations.select(pl.col("timestamp").alias("next_calibration_timestamp")),
+                left_on="timestamp",
+                right_on="next_calibration_timestamp",
+                strategy="forward",
+            )
+            .join_asof(
+                self.trials.select(
+                    pl.col("trial").alias("next_trial"), pl.col("start").alias("next_trial_start")
+                ),
+                left_on="timestamp",
+                right_on="next_trial_start",
+                strategy="forward",
+            )
+            .with_columns(
+                (
+                    pl.col("next_calibration_timestamp")
+                    < pl.col("next_trial_start").fill_null(float("inf"))
+                )
+                .fill_null(False)
+                .alias("recalibrated")
+            )
+        )